@@ -1,10 +1,18 @@
 ﻿import os,sys
 sys.path.insert(0, "/opt/mantidnightly/bin") 
 sys.path.append("/isis/NDXLET/user/scripts/autoreduction") 
+sys.path.append("/isis/autoreduction_shared")
 
 
 from LETReduction import LETReduction
 import reduce_vars as web_var
+import direct_cache
+import archive_index
+import multi_ei
+
+# Reduce each incident energy of a multi Ei run in its own process, with at most EI_WORKERS
+PARALLEL_EI = True
+EI_WORKERS = 6
 
 #------------------------------------------------------------------------------------#
 #------------------------------------------------------------------------------------#
@@ -16,6 +24,50 @@ def main(input_file=None,output_dir=None):
 
         exception to change the output folder to save data to
     """
+    energies = []
+    incident_energy = web_var.standard_vars['incident_energy']
+    if PARALLEL_EI and multi_ei.has_several(incident_energy) and not web_var.standard_vars['sum_runs']:
+        # loaded once, to find the incident energies from its monitors and to reduce the first energy,
+        # from the file with the extension the reduction reads rather than the one that triggered it
+        file,ext = os.path.splitext(input_file)
+        run_file = file+web_var.advanced_vars['data_file_ext']
+        sample = multi_ei.load_run(run_file, 'multi_ei_sample')
+        energies = multi_ei.find_energies(sample.name(), incident_energy)
+        if len(energies) > 1:
+            multi_ei.reduce_energies(reduce_run, run_file, output_dir, energies, EI_WORKERS,
+                                     first=dict(sample=sample))
+        else:
+            multi_ei.unload_run(sample.name())
+    if len(energies) <= 1:
+        reduce_run(input_file, output_dir)
+
+    # Define folder for web service to copy results to
+    output_folder = ''
+    return output_folder
+
+def reduce_run(input_file, output_dir, ei=None, sample=None):
+    """ Reduce a run with the web variables, or only at the incident energy ei
+        when given, which is how multi_ei.reduce_energies calls it, and from the
+        sample workspace when it is already loaded
+    """
+    if ei is not None:
+        web_var.standard_vars['incident_energy'] = [ei]
+    if sample is not None:
+        web_var.standard_vars['sample_run'] = sample
+
+    # the monovanadium run is looked up in the archive index before Mantid's data search
+    archive_index.add_search_dirs('LET', [web_var.standard_vars['monovan_run']],
+                                  web_var.advanced_vars['data_file_ext'])
+    summed = web_var.standard_vars['sum_runs']
+    if summed:
+        # the sum of the earlier runs is kept in a local cache so only the new run is loaded, the
+        # summed workspace is then reduced as the sample run
+        runs = web_var.standard_vars['sample_run']
+        runs = list(runs) if isinstance(runs, (list, tuple)) else [runs]
+        runs.append(direct_cache.run_number(input_file, 'LET'))
+        web_var.standard_vars['sample_run'] = direct_cache.summed_runs(
+            'LET', runs, web_var.advanced_vars['data_file_ext'])
+        web_var.standard_vars['sum_runs'] = False
 
     # note web variables initialization
     rd = LETReduction(web_var)
@@ -24,11 +76,16 @@ def main(input_file=None,output_dir=None):
     fext = rd.reducer.prop_man.data_file_ext
     input_file = file+fext
     
-    rd.reduce(input_file,output_dir)
-    
-    # Define folder for web service to copy results to
-    output_folder = ''
-    return output_folder
+    # the white beam is the same for the whole experiment, so its integrals and, with a hard mask only,
+    # the diagnostics masks are kept in a local cache, as is the run itself until they are known
+    wb_run = web_var.standard_vars['wb_run']
+    direct_cache.seed_white_beam(rd.reducer, 'LET', wb_run, web_var.advanced_vars['data_file_ext'])
+    # absolute units factors calculated for earlier runs with the same monovanadium are reused
+    direct_cache.seed_monovan_factors(rd.reducer)
+    rd.reduce(None if summed or sample is not None else input_file,output_dir)
+    direct_cache.store_white_beam(rd.reducer, 'LET', wb_run, web_var.advanced_vars['data_file_ext'])
+    direct_cache.store_monovan_factors(rd.reducer)
+    return rd.reducer
 
 if __name__ == "__main__":
 #------------------------------------------------------------------------------------#
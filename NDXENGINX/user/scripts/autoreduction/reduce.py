@@ -1,18 +1,22 @@
 import numpy  # Required due to Mantid4.0 import issue 
 import os
 import sys
-import time
 
 # Ensure that Mantid does not attempt to plot to display 
 os.environ['MPLBACKEND'] = 'Agg'
 
 sys.path.append("/isis/NDXENGINX/user/scripts/autoreduction")
 sys.path.append("/opt/Mantid/scripts") # Temporary solution until next Mantid release
+sys.path.append("/isis/autoreduction_shared")
 import reduce_vars as web_var
 import Engineering.EnginX as Enginx
 
-# Require early load import to check for event file
-from mantid.simpleapi import Load
+# Check for an event file from the NeXus header rather than loading the run
+import nexus_probe
+import file_ready
+
+# Maximum number of seconds to wait for the input file to finish being copied
+FILE_READY_TIMEOUT = 300
 
 def validate(input_file, output_dir):
     """
@@ -32,9 +36,7 @@ def validate(input_file, output_dir):
         if not os.path.isdir(dir):
             raise RuntimeError("Unable to find directory: {}".format(dir))
     # Skip run if Event workspace
-    enginx_ws = Load(input_file)
-    workspace_type = str(type(enginx_ws))
-    if 'Event' in workspace_type:
+    if nexus_probe.is_nexus(input_file) and nexus_probe.probe(input_file).is_event:
         raise RuntimeError('Skip: Event mode currently not supported on EnginX')
     print("Validation successful")
 
@@ -51,8 +53,8 @@ def main(input_file, output_dir):
 
     """
     # some files are not there when they are being read,
-    # hence introduce a sleep to ensure files are copied over in time.
-    time.sleep(10) 
+    # hence wait until the file has been completely copied over.
+    file_ready.wait_until_ready(input_file, timeout=FILE_READY_TIMEOUT)
     validate(input_file, output_dir)
     
     # Ensure that the variables for reduce_var.py are of the correct type
@@ -2,12 +2,15 @@ import numpy  # Required due to Mantid4.0 import issue
 import sys
 import os
 sys.path.append("/isis/NDXGEM/user/scripts/autoreduction")
+sys.path.append("/isis/autoreduction_shared")
 from isis_powder import Gem
 import reduce_vars as web_var
 import time
 
 # Require to check mode of operation
-from mantid.simpleapi import Load
+import nexus_probe
+
+MODE_LOGS = ['Phase_6m', 'Phase_9m', 'Phase_T0']
 
 def validate(input_file, output_dir):
     """
@@ -40,8 +43,7 @@ def main(input_file, output_dir):
     user = "autoreduce"
 
     if params['mode'] == '' or params['mode'] == None:
-        ws = Load(input_file)
-        mode = determine_mode(ws)
+        mode = determine_mode(read_mode_logs(input_file))
         if mode:
             print("Using {} mode for reduction.".format(mode))
             params['mode'] = mode
@@ -93,12 +95,19 @@ def main(input_file, output_dir):
 def get_run_number(path):
     return path.split(os.sep)[-1][3:][:-4]
 
+# Read the first values of MODE_LOGS, from the NeXus header when the file is NeXus and
+# otherwise, e.g. for a raw file, by loading the run
+def read_mode_logs(input_file):
+    if nexus_probe.is_nexus(input_file):
+        run_info = nexus_probe.probe(input_file, logs=MODE_LOGS)
+        return [run_info.first_log_value(name) for name in MODE_LOGS]
+    from mantid.simpleapi import Load
+    log_data = Load(input_file).getRun()
+    return [log_data.getProperty(name).value[0] for name in MODE_LOGS]
+
 # Determine if the mode of operation is PDF or Rietveld if this can't be determined, return None
-def determine_mode(workspace):
-    log_data = workspace.getRun()
-    value_6m = log_data.getProperty('Phase_6m').value[0]
-    value_9m = log_data.getProperty('Phase_9m').value[0]
-    value_t0 = log_data.getProperty('Phase_T0').value[0]
+def determine_mode(log_values):
+    value_6m, value_9m, value_t0 = log_values
     
     if value_6m == 503.0 and value_9m == 3.0 and value_t0 == 3.0:
         return 'Rietveld'
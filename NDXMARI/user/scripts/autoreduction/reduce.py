@@ -11,20 +11,30 @@ import sys
 
 AUTOREDUCTION_DIR = r"/isis/NDXMARI/user/scripts/autoreduction"
 sys.path.append(AUTOREDUCTION_DIR)
+sys.path.append("/isis/autoreduction_shared")
 
 import mantid.simpleapi
-from mantid.api import ScriptRepositoryFactory as srf
-repo = srf.Instance().create("ScriptRepositoryImpl")
-repo.install('/tmp/repo')
-# listFiles is required for any download call to be successful
-repo.listFiles()
-repo.download('direct_inelastic/MARI/MARIReduction_Sample.py')
-import MARIReduction_Sample as mari_red
+import script_cache
+import direct_cache
+import archive_index
+import multi_ei
+import qe_slice
+# The reduction script is served from a local cache and refreshed from the script repository in
+# the background, set the pin to a sha256 to always use that version of the script
+REDUCTION_SCRIPT = 'direct_inelastic/MARI/MARIReduction_Sample.py'
+REDUCTION_SCRIPT_PIN = None
+mari_red = script_cache.import_script(REDUCTION_SCRIPT, pin=REDUCTION_SCRIPT_PIN)
 
 import reduce_vars as web_var
 config['default.facility'] = 'ISIS'
 config['datasearch.searcharchive'] = 'on'
 
+# Reduce each incident energy of a multi Ei run in its own process, with at most EI_WORKERS
+PARALLEL_EI = True
+EI_WORKERS = 6
+# Slices are made from the reduced workspaces with 'numpy', or with 'mslice' from the saved nxspe files
+SLICE_METHOD = 'numpy'
+
 def validate(input_file, output_dir):
     """
     Autoreduction validate Function
@@ -50,7 +60,38 @@ def main(input_file, output_dir):
     standard_params = web_var.standard_vars
     advanced_params = web_var.advanced_vars
 
+    energies = []
+    incident_energy = standard_params['incident_energy']
+    if PARALLEL_EI and multi_ei.has_several(incident_energy) and not standard_params['sum_runs']:
+        # loaded once, to find the incident energies from its monitors and to reduce the first energy,
+        # from the file with the extension the reduction reads rather than the one that triggered it
+        run_file = os.path.splitext(input_file)[0] + advanced_params['data_file_ext']
+        sample = multi_ei.load_run(run_file, 'multi_ei_sample')
+        energies = multi_ei.find_energies(sample.name(), incident_energy)
+        if len(energies) > 1:
+            # each energy makes its own slice
+            multi_ei.reduce_energies(reduce_run, run_file, output_dir, energies, EI_WORKERS,
+                                     first=dict(sample=sample), plot=standard_params['plot_type'] == 'slice')
+        else:
+            multi_ei.unload_run(sample.name())
+    if len(energies) <= 1:
+        reduce_run(input_file, output_dir, plot=standard_params['plot_type'] == 'slice')
+
+
+def reduce_run(input_file, output_dir, ei=None, plot=False, sample=None):
+    """
+    Reduce a run with the web variables, or only at the incident energy ei when given,
+    which is how multi_ei.reduce_energies calls it, and make the slice plots. The sample
+    workspace is reduced in place of input_file when the run is already loaded.
+    """
+    standard_params = web_var.standard_vars
+    advanced_params = web_var.advanced_vars
+
     config['defaultsave.directory'] = output_dir
+    # iliad_mari takes run numbers, so put the directories of input_file, the workers' local copy in the
+    # parallel Ei mode, and of the monovanadium run from the archive index first in Mantid's data search
+    archive_index.add_search_dirs('MARI', [standard_params['monovan_run']], advanced_params['data_file_ext'])
+    config['datasearch.directories'] = os.path.dirname(input_file) + ';' + config['datasearch.directories']
 
     kwargs = {}
     if advanced_params['hard_mask_file'] and advanced_params['hard_mask_file'] != 'None':
@@ -59,9 +100,13 @@ def main(input_file, output_dir):
         kwargs['hard_mask_file'] = None
 
     run_number = get_run_number(input_file)
-    output_ws_list = mari_red.iliad_mari(runno=run_number,
-                                         ei=standard_params['incident_energy'],
-                                         wbvan=standard_params['white_beam_run'],
+    # the white beam run is the same for the whole experiment so is kept in a local cache
+    wbvan = standard_params['white_beam_run']
+    if wbvan:
+        wbvan = direct_cache.white_beam('MARI', wbvan, advanced_params['data_file_ext'])
+    output_ws_list = mari_red.iliad_mari(runno=run_number if sample is None else sample,
+                                         ei=standard_params['incident_energy'] if ei is None else [ei],
+                                         wbvan=wbvan,
                                          monovan=standard_params['monovan_run'],
                                          sam_mass=standard_params['sample_mass'],
                                          sam_rmm=standard_params['sample_rmm'],
@@ -69,8 +114,9 @@ def main(input_file, output_dir):
                                          check_background=advanced_params['check_background'],
                                          map_file=os.path.join(AUTOREDUCTION_DIR, advanced_params['map_file']),
                                          **kwargs)
-    if standard_params['plot_type'] == 'slice':
+    if plot:
         slice_plot(run_number, output_ws_list, output_dir)
+    return output_ws_list
 
 
 def slice_plot(run_number, workspaces_to_plot, output_dir):
@@ -81,12 +127,30 @@ def slice_plot(run_number, workspaces_to_plot, output_dir):
     The slice viewer provides the best first look at the data. As such, we will generate and
     save the slice images to CEPH and these will be picked up and displayed by the webapp
     :param workspaces_to_plot: A list of mantid workspaces to generate slices for.
-                               Names for plots should be generated from workspace name.
+                               Names for plots are generated from the run number and Ei.
+    """
+    if SLICE_METHOD == 'mslice':
+        mslice_plot(run_number, output_dir)
+        return
+    if not isinstance(workspaces_to_plot, (list, tuple)):
+        workspaces_to_plot = [workspaces_to_plot]
+    jobs = []
+    for workspace in workspaces_to_plot:
+        if isinstance(workspace, str):
+            workspace = mantid.simpleapi.mtd[workspace]
+        job = qe_slice.workspace_slice(workspace)
+        job['title'] = 'MAR{}_Ei{:<3.2f}meV'.format(run_number, job['ei'])
+        job['filename'] = os.path.join(output_dir, job['title'] + '.png')
+        jobs.append(job)
+    # drawn one after another, as starting processes for a handful of plots costs more than it saves
+    for job in jobs:
+        qe_slice.render_slice(**job)
+
+
+def mslice_plot(run_number, output_dir):
+    """
+    Generate the slices with mslice from the nxspe files saved in output_dir
     """
-    #for workspace in workspaces_to_plot:
-    #    ei_name = '{:<3.2f}'.format(workspace.run().getProperty('Ei').value)
-    #    plot_name = f"MAR{run_number}_Ei{ei_name}meV"
-    #    file_path = os.path.join(output_dir, f"{plot_name}.nxspe")
     for file in os.listdir(output_dir):
         if '.nxspe' not in file or f'MAR{run_number}' not in file:
             continue
@@ -1,16 +1,39 @@
 from __future__ import print_function
 import numpy  # Required due to Mantid4.0 import issue 
 import os,sys
+import resource
 sys.path.insert(0, "/opt/Mantid/bin")
 sys.path.append("/isis/NDXWISH/user/scripts/autoreduction") 
+sys.path.append("/isis/autoreduction_shared")
 
 # Set of routines to normalise WISH data- new look Mantid with mantidsimple removed
 from mantid.simpleapi import *
 #import matplotlib.pyplot as p # Had to remove matplotlib as autoreduce running on server without display
 import numpy as n
+import parallel_utils
+import cache_utils
+import wish_calibration
+import output_writer
 
 wish_dir=""
 
+# Calibration files for each sample environment and cycle, and the panel spectrum ranges
+calibration=wish_calibration.CalibrationRegistry.from_file()
+
+wish_eventfocus=False
+
+# Processed incident monitors, kept in memory for the panels of a run and on disk between jobs
+MONITOR_SPLINE_TERMS=70
+MONITOR_CACHE_DAYS=30
+monitor_cache_stats={"hits":0,"disk_hits":0,"misses":0}
+
+# Panels are reduced in separate processes, limited by the cores and the memory needed per panel
+PANEL_WORKERS=10
+PANEL_MEMORY_MB=3000
+
+# Panels either side of the beam that are summed, low angle panel first
+PAIRED_BANKS=[(5,6),(4,7),(3,8),(2,9),(1,10)]
+
 
 def validate(input_file, output_dir):
     """
@@ -62,6 +85,30 @@ def WISH_setdatafile(filename):
 def WISH_getdatafile():
     return wish_datafile
 
+# When set, event data stays as events until after focussing so that the ~194k spectra are never
+# histogrammed, otherwise each panel is histogrammed when it is read. Off until the event path has
+# been checked against a histogram mode reduction of the same run.
+def WISH_seteventfocus(eventfocus):
+    global wish_eventfocus
+    wish_eventfocus=eventfocus
+
+def WISH_eventfocus():
+    return wish_eventfocus
+
+# Histogram a panel of event data unless the events are kept for focussing. Kept events still get
+# the usual bins, NormaliseToMonitor rebins the monitor onto them and with the single bin of a freshly
+# loaded event workspace would divide every event by the same value.
+def WISH_histogram(output):
+    if (WISH_eventfocus()):
+        Rebin(InputWorkspace=output,OutputWorkspace=output,Params='6000,-0.00063,110000',PreserveEvents=True)
+    else:
+        Rebin(InputWorkspace=output,OutputWorkspace=output,Params='6000,-0.00063,110000')
+        ConvertToMatrixWorkspace(output,output)
+
+# Peak memory use of this process for the job log
+def WISH_peakrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
 def WISH_datadir():
     return wish_datadir
 
@@ -102,30 +149,7 @@ def WISH_group():
     #return "/home/ryb18365/Desktop/WISH_cycle_10_3_noends_10to10_dodgytubesremoved.cal"
 
 def WISH_getvana(panel,SE="candlestick",cycle="09_4"): 
-    if (SE=="candlestick"):
-        if (cycle=="09_2"):
-            return WISH_calibration()+"vana318-"+str(panel)+"foc-rmbins-smooth50.nx5"
-        if (cycle=="09_3"):
-            return WISH_calibration(cycle)+"vana935-"+str(panel)+"foc-SS.nx5"
-        if (cycle=="09_4"):
-            return WISH_calibration(cycle)+"vana3123-"+str(panel)+"foc-SS.nx5"
-        if (cycle=="09_5"):
-            return WISH_calibration(cycle)+"vana3123-"+str(panel)+"foc-SS.nx5"
-        if (cycle=="11_4"):
-            return WISH_calibration(cycle)+"vana19612-"+str(panel)+"foc-SF-SS.nxs"
-    if (SE=="WISHcryo"):
-        if (cycle=="09_2"):
-            return WISH_calibration()+"vana318-"+str(panel)+"foc-rmbins-smooth50.nx5"
-        if (cycle=="09_3"):
-            return WISH_calibration(cycle)+"vana935-"+str(panel)+"foc-SS.nx5"
-        if (cycle=="09_4"):
-            return WISH_calibration(cycle)+"vana3123-"+str(panel)+"foc-SS.nx5"
-        if (cycle=="11_1"):
-            return WISH_calibration(cycle)+"vana17718-"+str(panel)+"foc-SS.nxs"
-        if (cycle=="11_2"):
-            return WISH_calibration(cycle)+"vana16812-"+str(panel)+"foc-SS.nx5"
-        if (cycle=="11_3"):
-            return WISH_calibration(cycle)+"vana18590-"+str(panel)+"foc-SS-new.nxs"
+    return calibration.vanadium(panel,SE,cycle)
 
 
 def split_string(t):
@@ -137,34 +161,10 @@ def split_string(t):
     return int(t[0:indxp]),int(t[indxp+1:len(t)])
 
 def WISH_getemptyinstrument(panel,cycle="09_4"):
-    if (cycle=="09_4"):
-        return WISH_calibration(cycle)+"emptyinst3120-"+str(panel)+"foc.nx5"
+    return calibration.empty_instrument(panel,cycle)
 
 def WISH_getempty(panel,SE="WISHcryo",cycle="09_4"):
-    if (SE=="WISHcryo"):
-        if (cycle=="09_2"):
-            return WISH_calibration(cycle)+"emptycryo322-"+str(panel)+"-smooth50.nx5"
-        if (cycle=="09_3"):
-            return WISH_calibration(cycle)+"emptycryo1725-"+str(panel)+"foc.nx5"
-        if (cycle=="09_4"):
-            return WISH_calibration(cycle)+"emptycryo3307-"+str(panel)+"foc.nx5"
-        if (cycle=="09_5"):
-            return WISH_calibration(cycle)+"emptycryo16759-"+str(panel)+"foc.nx5"
-        if (cycle=="11_1"):
-            return WISH_calibration(cycle)+"emptycryo17712-"+str(panel)+"foc-SS.nxs"
-        if (cycle=="11_2"):
-            return WISH_calibration(cycle)+"emptycryo16759-"+str(panel)+"foc-SS.nx5"
-        if (cycle=="11_3"):
-            return WISH_calibration(cycle)+"emptycryo17712-"+str(panel)+"foc-SS-new.nxs"
-        if (cycle=="11_4"):
-            return WISH_calibration(cycle)+"empty_mag20620-"+str(panel)+"foc-HR-SF.nxs"
-    if (SE=="candlestick"):
-        if (cycle=="09_4"):
-            return WISH_calibration(cycle)+"emptyinst3120-"+str(panel)+"foc.nxs"
-        if (cycle=="09_3"):
-            return WISH_calibration(cycle)+"emptyinst1726-"+str(panel)+"foc-monitor.nxs"
-        if (cycle=="11_4"):
-            return WISH_calibration(cycle)+"emptyinst19618-"+str(panel)+"foc-SF-S.nxs"
+    return calibration.empty(panel,SE,cycle)
 
 
 def WISH_getfilename(run_number,ext):
@@ -181,47 +181,20 @@ def WISH_getfilename(run_number,ext):
     return filename
 
 def WISH_returnpanel(panel):
-    if (panel==1):
-        min=6
-        max=19461
-    elif (panel==2):
-        min=19462
-        max=38917
-    elif( panel==3):
-        min=38918
-        max=58373
-    elif (panel==4):
-        min=58374
-        max=77829
-    elif (panel==5):
-        min=77830
-        max=97285
-    elif (panel==6):
-        min=97286
-        max=116741
-    elif (panel==7):
-        min=116742
-        max=136197
-    elif (panel==8):
-        min=136198
-        max=155653
-    elif (panel==9):
-        min=155654
-        max=175109
-    elif (panel==10):
-        min=175110
-        max=194565
-    elif (panel==0):
-        min=6
-        max=194565
-    return min,max
+    return calibration.panel_range(panel)
+
+# Crop one panel from a workspace holding all of the panels
+def WISH_croppanel(whole,output,panel):
+    min,max=WISH_returnpanel(panel)
+    CropWorkspace(InputWorkspace=whole,OutputWorkspace=output,StartWorkspaceIndex=min-6,EndWorkspaceIndex=max-6)
 
 # This function no longer works for a list of numbers
 # Reads a wish data file return a workspace with a short name
 def WISH_read(number,panel,ext):
     if type(number) is int:
         filename = WISH_getdatafile()  # Changed as full path is set in main now
-        ext = filename.split('.')[-1]  # Get the extension from the inputted filename
+        if (ext[0:10]!="nxs_event_"):  # Time slices keep their label and range
+            ext = filename.split('.')[-1]  # Get the extension from the inputted filename
         print("Extension is: {}".format(ext))
         #if (ext[0:10]=="nxs_event"):
         #    filename=WISH_getfilename(number,"nxs")
@@ -235,20 +208,28 @@ def WISH_read(number,panel,ext):
             LoadRaw(Filename=filename,OutputWorkspace=output,SpectrumMin=str(min),SpectrumMax=str(max),LoadLogFiles="0")
             MaskBins(InputWorkspace=output,OutputWorkspace=output,XMin=99900,XMax=106000)
             print("Standard raw file loaded")
-        if (ext[0]=="s"):
+        elif (ext[0]=="s"):
             LoadRaw(Filename=filename,OutputWorkspace=output,SpectrumMin=str(min),SpectrumMax=str(max),LoadLogFiles="0")
             MaskBins(InputWorkspace=output,OutputWorkspace=output,XMin=99900,XMax=106000)
             print("sav file loaded")
-        if (ext=="nxs_event"):
+        elif (ext=="nxs_event"):
             LoadEventNexus(Filename=filename,OutputWorkspace=output,LoadMonitors='1')
             RenameWorkspace(output+"_monitors","w"+str(number)+"_monitors")
-            Rebin(InputWorkspace=output,OutputWorkspace=output,Params='6000,-0.00063,110000')
-            ConvertToMatrixWorkspace(output,output)
-            min,max=WISH_returnpanel(panel)
-            CropWorkspace(InputWorkspace=output,OutputWorkspace=output,StartWorkspaceIndex=min-6,EndWorkspaceIndex=max-6)
+            # crop to the panel before histogramming rather than histogramming every spectrum
+            WISH_croppanel(output,output,panel)
+            WISH_histogram(output)
             MaskBins(InputWorkspace=output,OutputWorkspace=output,XMin=99900,XMax=106000)
             print("Full nexus eventfile loaded")
-        if (ext[0:10]=="nxs_event_"):
+        elif (ext[0:10]=="nxs_event_" and mtd.doesExist("w"+str(number)+"_slice_"+split_string_event(ext)[0])):
+            # slice already filtered from a single load by WISH_loadslices, crop the panel before histogramming
+            label,tmin,tmax=split_string_event(ext)
+            output=output+"_"+label
+            WISH_croppanel("w"+str(number)+"_slice_"+label,output,panel)
+            CloneWorkspace(InputWorkspace="w"+str(number)+"_slicemon_"+label,OutputWorkspace="w"+str(number)+"_monitors")
+            WISH_histogram(output)
+            MaskBins(output,output,XMin=99900,XMax=106000)
+            print("Panel {} cropped from slice {}".format(panel,label))
+        elif (ext[0:10]=="nxs_event_"):
             label,tmin,tmax=split_string_event(ext)
             output=output+"_"+label
             if (tmax=="end"):
@@ -257,13 +238,11 @@ def WISH_read(number,panel,ext):
                 LoadEventNexus(Filename=filename,OutputWorkspace=output,FilterByTimeStart=tmin,FilterByTimeStop=tmax,LoadMonitors='1',MonitorsAsEvents='1',FilterMonByTimeStart=tmin,FilterMonByTimeStop=tmax)
             RenameWorkspace(output+"_monitors","w"+str(number)+"_monitors")
             print("Renaming monitors done")
-            Rebin(InputWorkspace=output,OutputWorkspace=output,Params='6000,-0.00063,110000')
-            ConvertToMatrixWorkspace(output,output)
-            min,max=WISH_returnpanel(panel)
-            CropWorkspace(InputWorkspace=output,OutputWorkspace=output,StartWorkspaceIndex=min-6,EndWorkspaceIndex=max-6)
+            WISH_croppanel(output,output,panel)
+            WISH_histogram(output)
             MaskBins(output,output,XMin=99900,XMax=106000)
             print("Nexus event file chopped")
-        if (ext=="nxs"):
+        elif (ext=="nxs"):
             LoadNexus(Filename=filename,OutputWorkspace=output,SpectrumMin=str(min),SpectrumMax=str(max))
             MaskBins(InputWorkspace=output,OutputWorkspace=output,XMin=99900,XMax=106000)
             print("standard histo nxs file loaded")
@@ -286,7 +265,7 @@ def WISH_read(number,panel,ext):
     ConvertUnits(InputWorkspace=output,OutputWorkspace=output,Target="Wavelength",Emode="Elastic")
     lmin,lmax=WISH_getlambdarange()
     CropWorkspace(InputWorkspace=output,OutputWorkspace=output,XMin=lmin,XMax=lmax)
-    monitor=WISH_process_incidentmon(number,ext,spline_terms=70,debug=False)
+    monitor=WISH_process_incidentmon(number,ext,spline_terms=MONITOR_SPLINE_TERMS,debug=False)
     print("first norm to be done")
     NormaliseToMonitor(InputWorkspace=output,OutputWorkspace=output+"norm1",MonitorWorkspace=monitor)
     print("second norm to be done")
@@ -295,13 +274,19 @@ def WISH_read(number,panel,ext):
     DeleteWorkspace(output+"norm1")
     RenameWorkspace(InputWorkspace=output+"norm2",OutputWorkspace=output)
     ConvertUnits(InputWorkspace=output,OutputWorkspace=output,Target="TOF",EMode="Elastic")
-    ReplaceSpecialValues(InputWorkspace=output,OutputWorkspace=output,NaNValue=0.0,NaNError=0.0,InfinityValue=0.0,InfinityError=0.0)
+    # event workspaces are cleaned up once they have been focussed and histogrammed
+    if (mtd[output].id()!="EventWorkspace"):
+        ReplaceSpecialValues(InputWorkspace=output,OutputWorkspace=output,NaNValue=0.0,NaNError=0.0,InfinityValue=0.0,InfinityError=0.0)
     return output
 
 #Focus dataset for a given panel and return the workspace
 def WISH_focus_onepanel(work,focus,panel):
     AlignDetectors(InputWorkspace=work,OutputWorkspace=work,CalibrationFile=WISH_cal(panel))
     DiffractionFocussing(InputWorkspace=work,OutputWorkspace=focus,GroupingFileName=WISH_group())
+    if (mtd[focus].id()=="EventWorkspace"):
+        # only the focussed spectra are histogrammed, with the same logarithmic step as the raw data
+        Rebin(InputWorkspace=focus,OutputWorkspace=focus,Params='-0.00063',PreserveEvents=False)
+        ReplaceSpecialValues(InputWorkspace=focus,OutputWorkspace=focus,NaNValue=0.0,NaNError=0.0,InfinityValue=0.0,InfinityError=0.0)
     if (panel==5 or panel==6):
         CropWorkspace(InputWorkspace=focus,OutputWorkspace=focus,XMin=0.3)
     DeleteWorkspace(work)
@@ -322,20 +307,42 @@ def WISH_focus(work,panel):
         WISH_focus_onepanel(work,focus,panel)
         WISH_split(focus)
 
+# Calculate the cylinder absorption correction for a panel in wavelength. The numerical integration
+# only depends on the geometry, material and binning so the result is cached on disk and reused
+# for every run with the same sample. Event data still has a single bin, so the correction is
+# calculated on a histogram with the same logarithmic steps as the histogrammed data instead.
+def WISH_absorption(work,output,panel,h,r,Xa,Xs,nd):
+    if (mtd[work].id()=="EventWorkspace"):
+        lmin,lmax=WISH_getlambdarange()
+        Rebin(InputWorkspace=work,OutputWorkspace=output,Params=str(lmin)+",-0.00063,"+str(lmax),PreserveEvents=False)
+        work=output
+    ws=mtd[work]
+    last=ws.getNumberHistograms()-1
+    binning=(last,ws.readX(0).tobytes(),ws.readX(last).tobytes(),str(ws.getInstrument().getValidFromDate()))
+    key=cache_utils.cache_key("CylinderAbsorption",panel,float(h),float(r),float(Xa),float(Xs),float(nd),binning)
+    cachefile=cache_utils.cache_path("WISH","absorption",key+".nxs")
+    if os.path.exists(cachefile):
+        LoadNexusProcessed(Filename=cachefile,OutputWorkspace=output)
+        print("Absorption correction loaded from {}".format(cachefile))
+    else:
+        CylinderAbsorption(InputWorkspace=work,OutputWorkspace=output,
+        CylinderSampleHeight=h,CylinderSampleRadius=r,AttenuationXSection=Xa,
+        ScatteringXSection=Xs,SampleNumberDensity=nd,
+        NumberOfSlices="10",NumberOfAnnuli="10",NumberOfWavelengthPoints="25",ExpMethod="Normal")
+        WISH_savecache(output,cachefile)
+    return output
+
 def WISH_process(number,panel,ext,SEsample="WISHcryo",emptySEcycle="09_4",SEvana="candlestick",cyclevana="09_4",absorb=False,nd=0.0,Xs=0.0,Xa=0.0,h=0.0,r=0.0):
     w=WISH_read(number,panel,ext)
     print("File read and normalized")
     if (absorb):
         ConvertUnits(InputWorkspace=w,OutputWorkspace=w,Target="Wavelength",EMode="Elastic")
-        CylinderAbsorption(InputWorkspace=w,OutputWorkspace="T",
-        CylinderSampleHeight=h,CylinderSampleRadius=r,AttenuationXSection=Xa,
-        ScatteringXSection=Xs,SampleNumberDensity=nd,
-        NumberOfSlices="10",NumberOfAnnuli="10",NumberOfWavelengthPoints="25",ExpMethod="Normal")
+        WISH_absorption(w,"T",panel,h,r,Xa,Xs,nd)
         Divide(LHSWorkspace=w,RHSWorkspace="T",OutputWorkspace=w)
         DeleteWorkspace("T")
         ConvertUnits(InputWorkspace=w,OutputWorkspace=w,Target="TOF",EMode="Elastic")
     wfoc=WISH_focus(w,panel)
-    print("Focussing done")
+    print("Focussing done, peak RSS {:.0f} MB".format(WISH_peakrss()))
     if type(number) is int:
         wfocname="w"+str(number)+"-"+str(panel)+"foc"
         if (len(ext)>9):
@@ -413,6 +420,130 @@ def WISH_process(number,panel,ext,SEsample="WISHcryo",emptySEcycle="09_4",SEvana
         SaveFocusedXYE(wfocname,WISH_userdir()+str(number)+"-"+str(panel)+ext+".dat")
         SaveNexusProcessed(wfocname,WISH_userdir()+str(number)+"-"+str(panel)+ext+".nxs")
     return wfocname
+# Runs in a worker process started by WISH_process_panels
+def WISH_process_panel(input_file,output_dir,number,panel,ext,process_kwargs,monitor=None,monitor_file=None):
+    WISH_setuserdir(output_dir)
+    WISH_setdatafile(input_file)
+    if (monitor_file is not None):
+        LoadNexusProcessed(Filename=monitor_file,OutputWorkspace=monitor)
+    wfocname=WISH_process(number,panel,ext,**process_kwargs)
+    return wfocname,WISH_userdir()+str(number)+"-"+str(panel)+ext+".nxs"
+
+# Process the panels in a pool of worker processes, each with its own Mantid instance, which
+# reads only its own panel's spectra from the file. The incident monitor is the same for every
+# panel so it is processed here, once, and loaded by the workers. The focussed panels saved by
+# the workers are loaded back for the pairing of the banks.
+def WISH_process_panels(number,panels,ext,workers,**process_kwargs):
+    fext=WISH_getdatafile().split('.')[-1]
+    monitor_kwargs={}
+    if (fext in ("raw","nxs") or fext[0]=="s"):
+        monitor=WISH_process_incidentmon(number,fext,spline_terms=MONITOR_SPLINE_TERMS,debug=False)
+        monitor_kwargs=dict(monitor=monitor,monitor_file=WISH_monitorfile(monitor))
+    jobs=[dict(input_file=WISH_getdatafile(),output_dir=WISH_userdir(),number=number,panel=panel,ext=ext,
+               process_kwargs=process_kwargs,**monitor_kwargs) for panel in panels]
+    wouts=[]
+    for wfocname,filename in parallel_utils.run_script_pool(os.path.abspath(__file__),"WISH_process_panel",jobs,workers):
+        LoadNexusProcessed(Filename=filename,OutputWorkspace=wfocname)
+        wouts.append(wfocname)
+    return wouts
+
+# Split an event run into slices with one load of the file and one FilterEvents pass, rather than
+# a LoadEventNexus for every slice. slices is a list of (label,start,stop) with the start and stop in
+# seconds from the start of the run, stop may be "end", or with log_name set the range of that log's
+# values. Labels must not contain "_". Returns the nxs_event_<label>_<start>_<stop> extensions
+# to pass to WISH_process for each slice.
+def WISH_loadslices(number,filename,slices,log_name=None):
+    whole="w"+str(number)+"_events"
+    LoadEventNexus(Filename=filename,OutputWorkspace=whole,LoadMonitors='1',MonitorsAsEvents='1')
+    splitter=CreateEmptyTableWorkspace(OutputWorkspace="w"+str(number)+"_splitter")
+    splitter.addColumn("double","start")
+    splitter.addColumn("double","stop")
+    splitter.addColumn("str","target")
+    if log_name is None:
+        for label,start,stop in slices:
+            splitter.addRow([float(start),1.0e10 if stop=="end" else float(stop),label])
+    else:
+        run=mtd[whole].getRun()
+        log=run.getProperty(log_name)
+        runstart=n.datetime64(run.startTime().toISO8601String().rstrip("Z"),"ns")
+        times=(n.append(log.times,n.datetime64(run.endTime().toISO8601String().rstrip("Z"),"ns"))-runstart)/n.timedelta64(1,"s")
+        values=n.asarray(log.value,dtype=float)
+        for label,start,stop in slices:
+            # intervals between log entries whose value is inside the range
+            inside=(values>=float(start))&(values<float(stop))
+            for k in n.nonzero(inside)[0]:
+                splitter.addRow([float(times[k]),float(times[k+1]),label])
+    FilterEvents(InputWorkspace=whole,SplitterWorkspace=splitter,OutputWorkspaceBaseName="w"+str(number)+"_slice",
+                 RelativeTime=True,GroupWorkspaces=False,OutputTOFCorrectionWorkspace="w"+str(number)+"_tofcorr")
+    FilterEvents(InputWorkspace=whole+"_monitors",SplitterWorkspace=splitter,OutputWorkspaceBaseName="w"+str(number)+"_slicemon",
+                 RelativeTime=True,GroupWorkspaces=False,OutputTOFCorrectionWorkspace="w"+str(number)+"_tofcorr")
+    for name in [whole,whole+"_monitors",splitter.name(),"w"+str(number)+"_tofcorr"]:
+        if mtd.doesExist(name):
+            DeleteWorkspace(name)
+    exts=[]
+    for label,start,stop in slices:
+        if mtd.doesExist("w"+str(number)+"_slice_"+label):
+            exts.append("nxs_event_"+label+"_"+str(start)+"_"+str(stop))
+        else:
+            print("No events in slice {}".format(label))
+    return exts
+
+# Runs in a worker process started by WISH_process_slices
+def WISH_process_slicefile(input_file,output_dir,number,ext,slice_file,monitor_file,panels,process_kwargs):
+    WISH_setuserdir(output_dir)
+    WISH_setdatafile(input_file)
+    label=split_string_event(ext)[0]
+    LoadNexusProcessed(Filename=slice_file,OutputWorkspace="w"+str(number)+"_slice_"+label)
+    LoadNexusProcessed(Filename=monitor_file,OutputWorkspace="w"+str(number)+"_slicemon_"+label)
+    return [(WISH_process(number,panel,ext,**process_kwargs),WISH_userdir()+str(number)+"-"+str(panel)+ext+".nxs")
+            for panel in panels]
+
+# Reduce every slice of an event run through the focus, empty and vanadium chain from a single load.
+# With workers > 1 the slices are saved to the local cache directory and reduced in separate processes.
+def WISH_process_slices(number,slices,panels=range(1,11),log_name=None,workers=1,**process_kwargs):
+    exts=WISH_loadslices(number,WISH_getdatafile(),slices,log_name)
+    wouts=[]
+    if (workers>1):
+        jobs=[]
+        for ext in exts:
+            label=split_string_event(ext)[0]
+            slice_file=cache_utils.cache_path("WISH","slices",str(number)+"_"+label+".nxs")
+            monitor_file=cache_utils.cache_path("WISH","slices",str(number)+"_"+label+"_monitors.nxs")
+            SaveNexusProcessed(InputWorkspace="w"+str(number)+"_slice_"+label,Filename=slice_file)
+            SaveNexusProcessed(InputWorkspace="w"+str(number)+"_slicemon_"+label,Filename=monitor_file)
+            jobs.append(dict(input_file=WISH_getdatafile(),output_dir=WISH_userdir(),number=number,ext=ext,slice_file=slice_file,
+                             monitor_file=monitor_file,panels=list(panels),process_kwargs=process_kwargs))
+        for job,results in zip(jobs,parallel_utils.run_script_pool(os.path.abspath(__file__),"WISH_process_slicefile",jobs,workers)):
+            for wfocname,filename in results:
+                LoadNexusProcessed(Filename=filename,OutputWorkspace=wfocname)
+                wouts.append(wfocname)
+            os.remove(job["slice_file"])
+            os.remove(job["monitor_file"])
+    else:
+        for ext in exts:
+            for panel in panels:
+                wouts.append(WISH_process(number,panel,ext,**process_kwargs))
+    for ext in exts:
+        label=split_string_event(ext)[0]
+        for name in ["w"+str(number)+"_slice_"+label,"w"+str(number)+"_slicemon_"+label]:
+            if mtd.doesExist(name):
+                DeleteWorkspace(name)
+    return wouts
+
+# Sum each pair of focussed panels, rebinning the second onto the first, and convert the sums
+# to d-spacing. Returns the names of the summed workspaces, w<number>-<low>_<high>foc.
+def WISH_pairbanks(number,pairs):
+    wpairs=[]
+    for low,high in pairs:
+        wlow="w"+str(number)+"-"+str(low)+"foc"
+        whigh="w"+str(number)+"-"+str(high)+"foc"
+        wpair="w"+str(number)+"-"+str(low)+"_"+str(high)+"foc"
+        RebinToWorkspace(WorkspaceToRebin=whigh,WorkspaceToMatch=wlow,OutputWorkspace=whigh,PreserveEvents='0')
+        Plus(LHSWorkspace=wlow,RHSWorkspace=whigh,OutputWorkspace=wpair)
+        ConvertUnits(InputWorkspace=wpair,OutputWorkspace=wpair+"-d",Target="dSpacing",EMode="Elastic")
+        wpairs.append(wpair)
+    return wpairs
+
 #Create a corrected vanadium (normalise,corrected for attenuation and empty, strip peaks) and 
 # save a a nexus processed file.
 # It looks like smoothing of 100 works quite well
@@ -425,10 +556,7 @@ def WISH_createvan(van,empty,panel,smoothing,vh,vr,cycle_van="09_3",cycle_empty=
     print("Read vanadium and empty")
     DleteWorkspace(wempty)
     ConvertUnits(InputWorkspace=wvan,OutputWorkspace=wvan,Target="Wavelength",EMode="Elastic")
-    CylinderAbsorption(InputWorkspace=wvan,OutputWorkspace="T",
-    CylinderSampleHeight=str(vh),CylinderSampleRadius=str(vr),AttenuationXSection="4.8756",
-    ScatteringXSection="5.16",SampleNumberDensity="0.07118",
-    NumberOfSlices="10",NumberOfAnnuli="10",NumberOfWavelengthPoints="25",ExpMethod="Normal")
+    WISH_absorption(wvan,"T",panel,vh,vr,"4.8756","5.16","0.07118")
     Divide(LHSWorkspace=wvan,RHSWorkspace="T",OutputWorkspave=wvan)
     DeleteWorkspace("T")
     ConvertUnits(InputWorkspace=wvan,OutputWorkspace=wvan,Target="TOF",EMode="Elastic")
@@ -539,7 +667,49 @@ def WISH_PH_TOF(runnumber,tubemin):
 # Returns a smooth monitor spectrum
 
 
-def WISH_process_incidentmon(number,ext,spline_terms=20,debug=False):
+# Save a workspace to the cache directory, writing to a temporary name first so that a
+# concurrent job never loads a partial file
+def WISH_savecache(work,cachefile):
+    tempfile=cachefile+".tmp"+str(os.getpid())
+    SaveNexusProcessed(InputWorkspace=work,Filename=tempfile)
+    os.replace(tempfile,cachefile)
+
+# Key for the processed monitor cache, the data file signature picks up a run being rewritten
+def WISH_monitorkey(number,ext,spline_terms,smooth_points):
+    if type(number) is int:
+        fnames=[WISH_getdatafile()]
+    else:
+        fnames=[WISH_getfilename(n1,ext) for n1 in split_string(number)]
+    signatures=[cache_utils.file_signature(fname) for fname in fnames if os.path.exists(fname)]
+    return cache_utils.cache_key(str(number),ext,spline_terms,smooth_points,WISH_getlambdarange(),fnames,signatures)
+
+# File of a processed monitor in the cache directory, entries unused for MONITOR_CACHE_DAYS are removed
+def WISH_monitorfile(works):
+    return cache_utils.cache_path("WISH","monitors",works+".nxs")
+
+def WISH_process_incidentmon(number,ext,spline_terms=20,debug=False,smooth_points=40):
+    # The same monitor is used for every panel so it is only processed once per run, the
+    # workspace is named by the cache key so an existing one was processed the same way
+    key=WISH_monitorkey(number,ext,spline_terms,smooth_points)
+    works="monitor"+str(number)+"_"+key[:16]
+    if (mtd.doesExist(works)):
+        monitor_cache_stats["hits"]+=1
+        return works
+    cachefile=WISH_monitorfile(works)
+    if (not debug and os.path.exists(cachefile)):
+        LoadNexusProcessed(Filename=cachefile,OutputWorkspace=works)
+        os.utime(cachefile,None)
+        monitor_cache_stats["disk_hits"]+=1
+    else:
+        monitor_cache_stats["misses"]+=1
+        processed=WISH_process_incidentmon_uncached(number,ext,spline_terms,debug,smooth_points)
+        RenameWorkspace(InputWorkspace=processed,OutputWorkspace=works)
+        WISH_savecache(works,cachefile)
+        cache_utils.prune(os.path.dirname(cachefile),MONITOR_CACHE_DAYS)
+    print("Incident monitor cache: {hits} hits, {disk_hits} disk hits, {misses} misses".format(**monitor_cache_stats))
+    return works
+
+def WISH_process_incidentmon_uncached(number,ext,spline_terms=20,debug=False,smooth_points=40):
     if type(number) is int:
         fname=WISH_getdatafile()
         works="monitor"+str(number)
@@ -591,7 +761,7 @@ def WISH_process_incidentmon(number,ext,spline_terms=20,debug=False):
         x,y,z=mtdplt.getnarray(works,0)
         p.plot(x,y)
         p.show()
-    SmoothData(InputWorkspace=works,OutputWorkspace=works,NPoints=40)
+    SmoothData(InputWorkspace=works,OutputWorkspace=works,NPoints=smooth_points)
     ConvertFromDistribution(works)
     return works
    
@@ -678,6 +848,9 @@ def main(input_file, output_dir):
     #print len(suffix)
     #print suffix[0], suffix[k]
 
+    # or reduce all of the slices from one load of the file, optionally in parallel
+    #wouts=WISH_process_slices(i,[("slice"+str(k),k*180,(k+1)*180) for k in range(0,nbslices)],range(1,11),workers=4,
+    #                          SEsample="candlestick",emptySEcycle="11_4",SEvana="candlestick",cyclevana="11_4")
     #for i in range(24901,24902):
     #	for j in range(2,3):
     #		for k in range(0,len(suffix)):
@@ -711,43 +884,28 @@ def main(input_file, output_dir):
     #		wout=WISH_process(i,j,"nxs_event_slice12_3300_end","WISHcryo","11_3","WISHcryo","11_3",absorb=False,nd=0.0,Xs=0.0,Xa=0.0,h=0.0,r=0.0)
 
     i = get_run_number(input_file)
-    for j in range(1,11):
-        wout=WISH_process(i,j,"raw","candlestick","11_4","candlestick","11_4",absorb=False,nd=0.0,Xs=0.0,Xa=0.0,h=4.0,r=0.4)
+    process_kwargs=dict(SEsample="candlestick",emptySEcycle="11_4",SEvana="candlestick",cyclevana="11_4",absorb=False,nd=0.0,Xs=0.0,Xa=0.0,h=4.0,r=0.4)
+    # fail now rather than after loading and focussing if a calibration file is missing
+    calibration.validate([("empty",process_kwargs["SEsample"],process_kwargs["emptySEcycle"]),
+                          ("vanadium",process_kwargs["SEvana"],process_kwargs["cyclevana"])])
+    workers=parallel_utils.max_workers(PANEL_WORKERS,PANEL_MEMORY_MB)
+    if (workers>1):
+        wouts=WISH_process_panels(i,range(1,11),"raw",workers,**process_kwargs)
+    else:
+        wouts=[WISH_process(i,j,"raw",**process_kwargs) for j in range(1,11)]
+    for wout in wouts:
         ConvertUnits(InputWorkspace=wout,OutputWorkspace=wout+"-d",Target="dSpacing",EMode="Elastic")
 #	SaveGSS("w"+str(i)+"-1foc",WISH_userdir()+str(i)+"-1foc"+".gss",Append=False,Bank=1)
 #	SaveFocusedXYE("w"+str(i)+"-1foc",WISH_userdir()+str(i)+"-1foc"+".dat")
 #	SaveGSS("w"+str(i)+"-2foc",WISH_userdir()+str(i)+"-2foc"+".gss",Append=False,Bank=1)
 #	SaveFocusedXYE("w"+str(i)+"-2foc",WISH_userdir()+str(i)+"-2foc"+".dat")
-    RebinToWorkspace(WorkspaceToRebin="w"+str(i)+"-6foc",WorkspaceToMatch="w"+str(i)+"-5foc",OutputWorkspace="w"+str(i)+"-6foc",PreserveEvents='0')
-    Plus(LHSWorkspace="w"+str(i)+"-5foc",RHSWorkspace="w"+str(i)+"-6foc",OutputWorkspace="w"+str(i)+"-5_6foc")
-    ConvertUnits(InputWorkspace="w"+str(i)+"-5_6foc",OutputWorkspace="w"+str(i)+"-5_6foc"+"-d",Target="dSpacing",EMode="Elastic")
-    SaveGSS("w"+str(i)+"-5_6foc",WISH_userdir()+str(i)+"-5_6raw"+".gss",Append=False,Bank=1)
-    SaveFocusedXYE("w"+str(i)+"-5_6foc",WISH_userdir()+str(i)+"-5_6raw"+".dat")
-    SaveNexusProcessed("w"+str(i)+"-5_6foc",WISH_userdir()+str(i)+"-5_6raw"+".nxs")
-    RebinToWorkspace(WorkspaceToRebin="w"+str(i)+"-7foc",WorkspaceToMatch="w"+str(i)+"-4foc",OutputWorkspace="w"+str(i)+"-7foc",PreserveEvents='0')
-    Plus(LHSWorkspace="w"+str(i)+"-4foc",RHSWorkspace="w"+str(i)+"-7foc",OutputWorkspace="w"+str(i)+"-4_7foc")
-    ConvertUnits(InputWorkspace="w"+str(i)+"-4_7foc",OutputWorkspace="w"+str(i)+"-4_7foc"+"-d",Target="dSpacing",EMode="Elastic")
-    SaveGSS("w"+str(i)+"-4_7foc",WISH_userdir()+str(i)+"-4_7raw"+".gss",Append=False,Bank=1)
-    SaveFocusedXYE("w"+str(i)+"-4_7foc",WISH_userdir()+str(i)+"-4_7raw"+".dat")
-    SaveNexusProcessed("w"+str(i)+"-4_7foc",WISH_userdir()+str(i)+"-4_7raw"+".nxs")
-    RebinToWorkspace(WorkspaceToRebin="w"+str(i)+"-8foc",WorkspaceToMatch="w"+str(i)+"-3foc",OutputWorkspace="w"+str(i)+"-8foc",PreserveEvents='0')
-    Plus(LHSWorkspace="w"+str(i)+"-3foc",RHSWorkspace="w"+str(i)+"-8foc",OutputWorkspace="w"+str(i)+"-3_8foc")
-    ConvertUnits(InputWorkspace="w"+str(i)+"-3_8foc",OutputWorkspace="w"+str(i)+"-3_8foc"+"-d",Target="dSpacing",EMode="Elastic")
-    SaveGSS("w"+str(i)+"-3_8foc",WISH_userdir()+str(i)+"-3_8raw"+".gss",Append=False,Bank=1)
-    SaveFocusedXYE("w"+str(i)+"-3_8foc",WISH_userdir()+str(i)+"-3_8raw"+".dat")
-    SaveNexusProcessed("w"+str(i)+"-3_8foc",WISH_userdir()+str(i)+"-3_8raw"+".nxs")
-    RebinToWorkspace(WorkspaceToRebin="w"+str(i)+"-9foc",WorkspaceToMatch="w"+str(i)+"-2foc",OutputWorkspace="w"+str(i)+"-9foc",PreserveEvents='0')
-    Plus(LHSWorkspace="w"+str(i)+"-2foc",RHSWorkspace="w"+str(i)+"-9foc",OutputWorkspace="w"+str(i)+"-2_9foc")
-    ConvertUnits(InputWorkspace="w"+str(i)+"-2_9foc",OutputWorkspace="w"+str(i)+"-2_9foc"+"-d",Target="dSpacing",EMode="Elastic")
-    SaveGSS("w"+str(i)+"-2_9foc",WISH_userdir()+str(i)+"-2_9raw"+".gss",Append=False,Bank=1)
-    SaveFocusedXYE("w"+str(i)+"-2_9foc",WISH_userdir()+str(i)+"-2_9raw"+".dat")
-    SaveNexusProcessed("w"+str(i)+"-2_9foc",WISH_userdir()+str(i)+"-2_9raw"+".nxs")
-    RebinToWorkspace(WorkspaceToRebin="w"+str(i)+"-10foc",WorkspaceToMatch="w"+str(i)+"-1foc",OutputWorkspace="w"+str(i)+"-10foc",PreserveEvents='0')
-    Plus(LHSWorkspace="w"+str(i)+"-1foc",RHSWorkspace="w"+str(i)+"-10foc",OutputWorkspace="w"+str(i)+"-1_10foc")
-    ConvertUnits(InputWorkspace="w"+str(i)+"-1_10foc",OutputWorkspace="w"+str(i)+"-1_10foc"+"-d",Target="dSpacing",EMode="Elastic")
-    SaveGSS("w"+str(i)+"-1_10foc",WISH_userdir()+str(i)+"-1_10raw"+".gss",Append=False,Bank=1)
-    SaveFocusedXYE("w"+str(i)+"-1_10foc",WISH_userdir()+str(i)+"-1_10raw"+".dat")
-    SaveNexusProcessed("w"+str(i)+"-1_10foc",WISH_userdir()+str(i)+"-1_10raw"+".nxs")
+    pairs=WISH_pairbanks(i,PAIRED_BANKS)
+    with output_writer.OutputWriter() as writer:
+        for (low,high),wpair in zip(PAIRED_BANKS,pairs):
+            outname=WISH_userdir()+str(i)+"-"+str(low)+"_"+str(high)+"raw"
+            writer.submit(SaveGSS,outname+".gss",InputWorkspace=wpair,Append=False,Bank=1)
+            writer.submit(SaveFocusedXYE,outname+".dat",InputWorkspace=wpair)
+            writer.submit(SaveNexusProcessed,outname+".nxs",InputWorkspace=wpair)
 
     #minus_emptycans(26977,26969)
     # #############################################################################################
@@ -0,0 +1,86 @@
+"""
+Registry of the WISH calibration files
+--------------------------------------
+
+The processed vanadium and empty runs for each sample environment and cycle,
+and the spectrum range of each panel, are read once from wish_calibration.json
+next to this file. Adding a cycle only needs a new entry in the JSON file.
+Unknown combinations raise a RuntimeError straight away rather than returning
+None, and validate() checks that the files a reduction will use exist before
+any data is loaded.
+"""
+import json
+import os
+
+import numpy as np
+
+REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wish_calibration.json')
+
+
+class CalibrationRegistry(object):
+    """
+    Lookup of the WISH calibration files and panel spectrum ranges
+    """
+
+    def __init__(self, index):
+        """
+        :param index: dictionary with the contents of wish_calibration.json
+        """
+        self.calibration_dir = index['calibration_dir']
+        # row n holds the first and last spectrum of panel n, row 0 is the whole instrument
+        self.panels = np.array(index['panels'], dtype=int)
+        self._files = {}
+        for kind in ('vanadium', 'empty'):
+            for sample_environment, cycles in index[kind].items():
+                for cycle, entry in cycles.items():
+                    self._files[(kind, sample_environment, cycle)] = entry
+        for cycle, entry in index['empty_instrument'].items():
+            self._files[('empty_instrument', None, cycle)] = entry
+
+    @classmethod
+    def from_file(cls, filename=REGISTRY_FILE):
+        with open(filename) as registry_file:
+            return cls(json.load(registry_file))
+
+    def panel_range(self, panel):
+        """
+        :return: the first and last spectrum numbers of the panel, panel 0 for all panels
+        """
+        if not 0 <= panel < len(self.panels):
+            raise RuntimeError("Unknown WISH panel: {}".format(panel))
+        first, last = self.panels[panel]
+        return int(first), int(last)
+
+    def vanadium(self, panel, sample_environment, cycle):
+        return self._lookup('vanadium', sample_environment, cycle, panel)
+
+    def empty(self, panel, sample_environment, cycle):
+        return self._lookup('empty', sample_environment, cycle, panel)
+
+    def empty_instrument(self, panel, cycle):
+        return self._lookup('empty_instrument', None, cycle, panel)
+
+    def validate(self, lookups, panels=range(1, 11)):
+        """
+        Check that the calibration files that will be used exist
+
+        :param lookups: list of (kind, sample environment, cycle) with kind one of vanadium, empty
+                        or empty_instrument
+        :param panels: the panels that will be reduced
+        """
+        missing = []
+        for kind, sample_environment, cycle in lookups:
+            for panel in panels:
+                filename = self._lookup(kind, sample_environment, cycle, panel)
+                if not os.path.isfile(filename):
+                    missing.append(filename)
+        if missing:
+            raise RuntimeError("Missing WISH calibration files:\n{}".format('\n'.join(missing)))
+
+    def _lookup(self, kind, sample_environment, cycle, panel):
+        try:
+            entry = self._files[(kind, sample_environment, cycle)]
+        except KeyError:
+            raise RuntimeError("No WISH {} calibration registered for sample environment {} in cycle {}".format(
+                kind, sample_environment, cycle))
+        return self.calibration_dir.format(cycle=entry['cycle']) + entry['file'].format(panel=panel)
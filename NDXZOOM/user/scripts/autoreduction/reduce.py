@@ -9,19 +9,25 @@ from matplotlib.colors import LogNorm
 from matplotlib.ticker import LogLocator
 import matplotlib.pyplot as plt
 import numpy as np
-import xml.etree.ElementTree as ET
 from sys import platform
 import os
 import sys
 import sans.command_interface.ISISCommandInterface as ici
-import h5py as h5py
 #print(dir(ici))
 # print(help(ici.PhiRanges))
 
 AUTOREDUCTION_DIR = r"/isis/NDXZOOM/user/scripts/autoreduction"
 sys.path.append(AUTOREDUCTION_DIR)
+SHARED_DIR = r"/isis/autoreduction_shared"
+sys.path.append(SHARED_DIR)
 
 import reduce_vars as web_var
+import nexus_probe
+import sans_journal
+import sans_parallel
+import sans_sectors
+import parallel_utils
+import archive_index
 
 # set
 inst='ZOOM'
@@ -56,14 +62,9 @@ def main(input_file, output_dir):
     config['defaultsave.directory'] = output_dir
 
     # Check if the data set is marked as a SANS run
-    # in the title by opening the nexus file directly
+    # in the title by reading the nexus header directly
     # if the run title doesn't finish with _SANS do nothing
-    f=h5py.File(input_file,'r')
-    dataset_names=list(f.keys())
-    main_data_set=dataset_names[0]
-    main_group=f[main_data_set]
-    title=main_group.get('title')[:][0].decode('UTF-8')
-    f.close()
+    title=nexus_probe.probe(input_file).title
     runtype=title.split('_')[-1]
     if runtype == 'SANS':
         SampleSANS=int(input_file[-12:-4])
@@ -98,10 +99,8 @@ def main(input_file, output_dir):
         # update the values of the various reduction runs from the journal
         # if possible. If the values are set by the web interface or the user
         # file then the value in the journal will be ignored
-        rblist=sortRBs()
         if RBNumber != None:
-            currRB=getCurrentRB(rblist,RBNumber)
-            [meas,trans]=parseMeasurements(rblist[currRB])
+            [meas,trans]=parseMeasurements(getRBRuns(RBNumber))
             for i in range(len(meas)):
                 if SampleSANS == meas[i][0]:
                     if SampleTRANS == None:
@@ -117,7 +116,8 @@ def main(input_file, output_dir):
         # now do the reduction using whatever values we have available.
         reduceSANS(sampleSANS=SampleSANS,sampleTRANS=SampleTRANS,canSANS=CanSANS, \
         canTRANS=CanTRANS,EBTRANS=EmptyBeamTRANS,maskfile=userfile,inst=inst,cycle=cycle, \
-        wavs=advanced_params['wl_ranges'],outputdir=output_dir)
+        wavs=advanced_params['wl_ranges'],outputdir=output_dir,max_workers=advanced_params.get('max_workers',1), \
+        sector_method=advanced_params.get('sector_method','qmap'),nsectors=advanced_params.get('n_sectors',4))
 
         # print a diagnostic string to a file
         debug='sampleSANS='+str(SampleSANS)+'\nsampleTRANS='+str(SampleTRANS)+'\ncansSANS='+str(CanSANS)
@@ -293,6 +293,14 @@ def plot1Ddata(datalist,titlewarning='',fig=None,axes1=None,axes2=None,axes3=Non
     axes3.legend().draggable()
 
 
+def runFile(run,inst=inst,cycle=cycle,prefix="/archive"):
+    # Path of the data file of a run. The archive index is checked first so runs from other
+    # cycles are found too, otherwise the file is assumed to be in the given cycle.
+    path=archive_index.find_run(inst,run,".nxs",archive_root=prefix)
+    if path is None:
+        path=prefix+"/NDX"+inst+"/Instrument/data/cycle_"+cycle+"/"+inst+"{:08d}.nxs".format(run)
+    return path
+
 def checkInputs(sampleSANS,sampleTRANS=None,canSANS=None,canTRANS=None,EBTRANS=None,maskfile=None):
     pass
 
@@ -323,18 +331,18 @@ def setupReduction(sampleSANS,sampleTRANS=None,canSANS=None,canTRANS=None,EBTRAN
         print('No Mask File Defined')
         return
     # assign the sample SANS run
-    ici.AssignSample(prefix+"/NDX"+inst+"/Instrument/data/cycle_"+cycle+"/"+inst+"{:08d}.nxs".format(sampleSANS))
+    ici.AssignSample(runFile(sampleSANS,inst,cycle,prefix))
 
     titleoption=0
     # if a can has been specified assign it
     if canSANS is not None:
-        ici.AssignCan(prefix+"/NDX"+inst+"/Instrument/data/cycle_"+cycle+"/"+inst+"{:08d}.nxs".format(canSANS))
+        ici.AssignCan(runFile(canSANS,inst,cycle,prefix))
         titleoption+=1
 
     # if a sample TRANS has been specified check that the empty beam has too and assign
     if sampleTRANS is not None and EBTRANS is not None:
-        TRsam=prefix+"/NDX"+inst+"/Instrument/data/cycle_"+cycle+"/"+inst+"{:08d}.nxs".format(sampleTRANS)
-        TREB=prefix+"/NDX"+inst+"/Instrument/data/cycle_"+cycle+"/"+inst+"{:08d}.nxs".format(EBTRANS)
+        TRsam=runFile(sampleTRANS,inst,cycle,prefix)
+        TREB=runFile(EBTRANS,inst,cycle,prefix)
         print(TRsam)
         print(TREB)
         ici.TransmissionSample(TRsam, TREB)
@@ -342,8 +350,8 @@ def setupReduction(sampleSANS,sampleTRANS=None,canSANS=None,canTRANS=None,EBTRAN
 
     # if a can TRANS has been specified check that the empty beam has too and assign
     if canTRANS is not None and EBTRANS is not None:
-        TRcan=prefix+"/NDX"+inst+"/Instrument/data/cycle_"+cycle+"/"+inst+"{:08d}.nxs".format(canTRANS)
-        TREB=prefix+"/NDX"+inst+"/Instrument/data/cycle_"+cycle+"/"+inst+"{:08d}.nxs".format(EBTRANS)
+        TRcan=runFile(canTRANS,inst,cycle,prefix)
+        TREB=runFile(EBTRANS,inst,cycle,prefix)
         print(TRcan)
         print(TREB)
         ici.TransmissionCan(TRcan, TREB)
@@ -360,14 +368,46 @@ def setupReduction(sampleSANS,sampleTRANS=None,canSANS=None,canTRANS=None,EBTRAN
 
     return titlewarning
 
-def reduceSANS(sampleSANS,sampleTRANS=None,canSANS=None,canTRANS=None,EBTRANS=None,maskfile=None,inst=inst,cycle=cycle,wavs=wavs,outputdir=''):
+def sectorsFromQmap(wksp2d,wksp1d,sectors):
+    # Average the 2D Q map into azimuthal sectors using the Q binning of the full 1D reduction,
+    # this replaces a full reduction with SetPhiLimit for each sector.
+    qmap=mtd[wksp2d]
+    nhist=qmap.getNumberHistograms()
+    qyaxis=qmap.getAxis(1).extractValues()
+    if len(qyaxis) == nhist:
+        # point axis, make bin edges half way between the points
+        qyaxis=np.concatenate(([1.5*qyaxis[0]-0.5*qyaxis[1]],0.5*(qyaxis[1:]+qyaxis[:-1]),[1.5*qyaxis[-1]-0.5*qyaxis[-2]]))
+    mask=np.zeros((nhist,qmap.blocksize()),dtype=bool)
+    for i in range(nhist):
+        if qmap.hasMaskedBins(i):
+            mask[i,list(qmap.maskedBinsIndices(i))]=True
+    integrator=sans_sectors.SectorIntegrator(qmap.readX(0),qyaxis,mtd[wksp1d].readX(0),sectors)
+    q,intensity,errors=integrator.integrate(qmap.extractY(),qmap.extractE(),mask)
+    wkspnames=[]
+    for i,(suffix,phimin,phimax) in enumerate(sectors):
+        CreateWorkspace(DataX=mtd[wksp1d].readX(0),DataY=intensity[i],DataE=errors[i],NSpec=1,
+                        UnitX='MomentumTransfer',Distribution=mtd[wksp1d].isDistribution(),
+                        YUnitLabel=mtd[wksp1d].YUnitLabel(),OutputWorkspace=wksp1d+suffix)
+        wkspnames.append(wksp1d+suffix)
+    return wkspnames
+
+def reduceSANS(sampleSANS,sampleTRANS=None,canSANS=None,canTRANS=None,EBTRANS=None,maskfile=None,inst=inst,cycle=cycle,wavs=wavs,outputdir='',max_workers=1,sector_method='qmap',nsectors=4):
     # This is the function that runs everything using the sans instrument command interface
     # by default the reduction will just reduce the sample sans with no transmission.
-    setupReduction(sampleSANS,sampleTRANS=sampleTRANS,canSANS=canSANS,canTRANS=canTRANS,EBTRANS=EBTRANS,maskfile=maskfile,inst=inst,cycle=cycle)
+    # With max_workers > 1 the wavelength overlap and sector reductions are spread over a
+    # pool of worker processes, each with their own Mantid instance.
+    # With sector_method='qmap' the anisotropy sectors are averaged from the 2D Q map rather than
+    # running a full reduction for each one, nsectors=4 gives the top/bottom/left/right halves and
+    # any other value that many equal sectors.
+    workers=parallel_utils.max_workers(max_workers)
+    setup_kwargs=dict(sampleSANS=sampleSANS,sampleTRANS=sampleTRANS,canSANS=canSANS,canTRANS=canTRANS, \
+    EBTRANS=EBTRANS,maskfile=maskfile,inst=inst,cycle=cycle)
+    setupReduction(**setup_kwargs)
 
     wkspnames=[]
     # Perform the full reduction listed in the userfile
     wksp1d=ici.WavRangeReduction(None, None, ici.DefaultTrans)
+    wkspfull=wksp1d
     SaveNXcanSAS(wksp1d,os.path.join(outputdir,wksp1d+'_autoreduced.h5'))
     SaveRKH(wksp1d,os.path.join(outputdir,wksp1d+'_autoreduced.dat'))
     wkspnames.append(wksp1d)
@@ -406,33 +446,36 @@ def reduceSANS(sampleSANS,sampleTRANS=None,canSANS=None,canTRANS=None,EBTRANS=No
 
     # Now perform the overlap reduction with different wavelength ranges
     ici.Set1D()
-    for i in range(len(wavs)-1):
-        wksp1d=ici.WavRangeReduction(wavs[i], wavs[i+1], False)
-        wkspnames.append(wksp1d)
+    if workers > 1:
+        overlaps=[dict(wav_start=wavs[i],wav_end=wavs[i+1],full_trans_wav=False) for i in range(len(wavs)-1)]
+        wkspnames+=sans_parallel.reduce_passes(os.path.abspath(__file__),setup_kwargs,overlaps,workers)
+    else:
+        for i in range(len(wavs)-1):
+            wksp1d=ici.WavRangeReduction(wavs[i], wavs[i+1], False)
+            wkspnames.append(wksp1d)
     #SaveNexus(mtd["{}rear_1D_0.9_12.5".format(run)],join(base_dir,"{}_1D.nxs".format(run)))
 
     plot1Ddata(wkspnames,fig=fig,axes1=axes[1,2],axes2=axes[1,0],axes3=axes[0,1])
 
-    # reset everything for the sector reduction
-    wkspnames=[]
-    setupReduction(sampleSANS,sampleTRANS=sampleTRANS,canSANS=canSANS,canTRANS=canTRANS,EBTRANS=EBTRANS,maskfile=maskfile,inst=inst,cycle=cycle)
     # perform reduction of 4 sectors to check for anisotropy
-    ici.SetPhiLimit(0.0,180.0,use_mirror=False)
-    wksp1d=ici.WavRangeReduction(None, None, ici.DefaultTrans)
-    RenameWorkspace(wksp1d,wksp1d+'_top')
-    wkspnames.append(wksp1d+'_top')
-    ici.SetPhiLimit(180.0,360.0,use_mirror=False)
-    wksp1d=ici.WavRangeReduction(None, None, ici.DefaultTrans)
-    RenameWorkspace(wksp1d,wksp1d+'_bottom')
-    wkspnames.append(wksp1d+'_bottom')
-    ici.SetPhiLimit(90.0,270.0,use_mirror=False)
-    wksp1d=ici.WavRangeReduction(None, None, ici.DefaultTrans)
-    RenameWorkspace(wksp1d,wksp1d+'_left')
-    wkspnames.append(wksp1d+'_left')
-    ici.SetPhiLimit(-90.0,90.0,use_mirror=False)
-    wksp1d=ici.WavRangeReduction(None, None, ici.DefaultTrans)
-    RenameWorkspace(wksp1d,wksp1d+'_right')
-    wkspnames.append(wksp1d+'_right')
+    wkspnames=[]
+    sectors=sans_sectors.HALF_SECTORS
+    if sector_method == 'qmap':
+        if nsectors != 4:
+            sectors=sans_sectors.equal_sectors(nsectors)
+        wkspnames=sectorsFromQmap(wksp2d,wkspfull,sectors)
+    elif workers > 1:
+        sectorpasses=[dict(full_trans_wav=ici.DefaultTrans,phi_limits=(phimin,phimax),suffix=suffix) \
+        for suffix,phimin,phimax in sectors]
+        wkspnames+=sans_parallel.reduce_passes(os.path.abspath(__file__),setup_kwargs,sectorpasses,workers)
+    else:
+        # reset everything for the sector reduction
+        setupReduction(**setup_kwargs)
+        for suffix,phimin,phimax in sectors:
+            ici.SetPhiLimit(phimin,phimax,use_mirror=False)
+            wksp1d=ici.WavRangeReduction(None, None, ici.DefaultTrans)
+            RenameWorkspace(wksp1d,wksp1d+suffix)
+            wkspnames.append(wksp1d+suffix)
     plot1Dsectors(wkspnames,fig=fig,axes=axes[1,1])
 
     fig.tight_layout()#pad=0.4, w_pad=0.5, h_pad=1.0)
@@ -453,7 +496,7 @@ def getjournal(inst,cycle):
     os.system('rm ~/temp.xml')
     os.system(cmd)
 
-def getXMLInfo(inst=inst,cycle=cycle):
+def getJournalFile(inst=inst,cycle=cycle):
     if platform == "linux" or platform == "linux2":
         xmlfile="/archive/NDX"+inst+"/instrument/logs/journal/journal_"+cycle+".xml"
         if not os.path.exists(xmlfile):
@@ -462,20 +505,7 @@ def getXMLInfo(inst=inst,cycle=cycle):
             #print(xmlfile)
     else:
         xmlfile="//isis/inst$/NDX"+inst+"/instrument/logs/journal/journal_"+cycle+".xml"
-
-    tree = ET.parse(xmlfile)
-    root = tree.getroot()
-    i=0
-    rnums = []
-    rbnums = []
-    titles = []
-    for child in root:
-        rnum = int(child.attrib['name'][-8:])
-        rnums.append(rnum)
-        rbnums.append(int(root[i][5].text))
-        titles.append(root[i][0].text)
-        i+=1
-    return [rnums,rbnums,titles]
+    return xmlfile
 
 def parseTitle(runtitle):
     # this will need to be extended to accomodate other bits later
@@ -498,24 +528,6 @@ def parseSANSTRANS(runtitle):
         sanstrans=0
     return sanstrans
 
-def sortRBs():
-    # Sort the journal list into rbnumberd lists
-    rnums,rbnums,titles=getXMLInfo()
-    rblist=[]
-    firstrb=-1
-    for i in range(len(rnums)):
-        if rbnums[i] != firstrb or i == len(rnums)-1:
-            if firstrb != -1:
-                rblist.append([runs,rbs,rtitles])
-            runs=[]
-            rbs=[]
-            rtitles=[]
-            firstrb=rbnums[i]
-        runs.append(int(rnums[i]))
-        rbs.append(rbnums[i])
-        rtitles.append(titles[i])
-    return rblist
-
 def findEB(rblist,rnum):
     # find the nearest empty beam run before the run of interest in the current RB
     ebnum=0
@@ -546,59 +558,15 @@ def gettitles(runtitle):
     return [samp,can]
 
 def parseMeasurements(rblist):
-    meas=[]
-    trans=[]
-    # parse the list looking for samples, cans and transmissions
-    for i in range(len(rblist[0])):
-        # check if we have a SANS run or not, if so create a measurement
-        st=parseSANSTRANS(rblist[2][i])
-        if  st == 1:
-            [samp,can]=gettitles(rblist[2][i])
-            if len(can) == 0:
-                meas.append([rblist[0][i],samp,-1,'',-1,-1])
-            else:
-                meas.append([rblist[0][i],samp,-1,can,-1,-1])
-        elif st == 2:
-            [samp,can]=gettitles(rblist[2][i])
-            if len(can) == 0:
-                meas.append([rblist[0][i],samp,-1,'',-1,-1])
-            else:
-                meas.append([rblist[0][i],samp,-1,can,-1,-1])
+    # Match samples, cans and transmissions in a single pass over the runs, where
+    # several runs share a title the latest one in the journal is used
+    return sans_journal.parse_measurements(rblist)
+
+def getRBRuns(rbnumber,inst=inst,cycle=cycle):
+    # Query the runs of a single RB from the cached journal index, only the entries
+    # appended to the journal since the last reduction are parsed
+    return sans_journal.get_rb_runs(getJournalFile(inst,cycle),inst,cycle,rbnumber)
 
-        else:
-            [samp,can]=gettitles(rblist[2][i])
-            trans.append([rblist[0][i],samp])
-    # now look for the matching transmission runs
-    for i in range(len(meas)):
-        for j in range(len(trans)):
-            if meas[i][1]==trans[j][1]:
-                meas[i][4]=trans[j][0]
-    # now look for can runs
-    for i in range(len(meas)):
-        for j in range(len(meas)):
-            if meas[i][3]==meas[j][1] and len(meas[i][1])>0:
-                meas[i][2]=meas[j][0]
-    # finally look for can trans
-    for i in range(len(meas)):
-        for j in range(len(trans)):
-            if meas[i][3]==trans[j][1] and len(meas[i][3])>0:
-                meas[i][5]=trans[j][0]
-    return [meas,trans]
-
-def getCurrentRB(rblist,rbnumber):
-    for i in range(len(rblist)):
-        if rblist[i][1][0] == rbnumber:
-            return i
-            break
-'''
-rblist=sortRBs()
-currRB=getCurrentRB(rblist,2010389)
-currRB=getCurrentRB(rblist,2010523)
-currRB=getCurrentRB(rblist,1910581)
-[meas,trans]=parseMeasurements(rblist[currRB])
-for i in range(len(meas)):
-    print(meas[i])
-'''
 #reduceSANS(51040,51039,51038,51037,51037,maskfile=maskfile)
 if __name__ == "__main__":
     #file='/archive/NDXLARMOR/Instrument/data/cycle_20_2/LARMOR00051565.nxs'
@@ -9,6 +9,9 @@ standard_vars = {
 }
 advanced_vars={
     'wl_ranges': [2.0, 4.0, 6.0, 8.0, 10.0, 12.0, 14.0, 16.0],
+    'max_workers': 1,
+    'sector_method': 'qmap',
+    'n_sectors': 4,
 }
 variable_help={
     'standard_vars' : {
@@ -20,5 +23,8 @@ variable_help={
     },
     'advanced_vars' : {
     'wl_ranges': 'Python of list wavelengths to produce the wavelength overlap plot for multiple scattering checks',
+    'max_workers': 'Maximum number of processes used to run the wavelength overlap and sector reductions in parallel, 1 to run them one after another',
+    'sector_method': "How the anisotropy sectors are produced, 'qmap' to average them from the 2D Q map or 'reduction' for a full reduction of each sector",
+    'n_sectors': 'Number of sectors when using the qmap method, 4 for the top, bottom, left and right halves or the number of equal sectors',
     },
 }
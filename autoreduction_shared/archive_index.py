@@ -0,0 +1,167 @@
+"""
+Index of the archive data files by instrument and run number
+------------------------------------------------------------
+
+Looking a run up through Mantid's data search walks every data search
+directory, several of them on network storage, for each run number the
+reduction needs. The runs in /archive/NDX<instrument>/Instrument/data/cycle_*
+are instead recorded in an SQLite database in the autoreduction cache and
+looked up directly.
+
+The index is brought up to date when a run isn't found in it. Only the cycle
+directories whose modification time has changed since they were last scanned,
+normally just the current cycle as new files are added to it, are listed
+again. Only files named after the instrument's file prefix and a run number
+are indexed, so that other files in the cycle directories, e.g. the
+LET00024374_1.nxs of a period, can't take the place of a run.
+Runs that still can't be found return None, and the caller falls back to
+Mantid's search.
+"""
+import glob
+import os
+import re
+import sqlite3
+
+from cache_utils import cache_key, cache_path
+
+ARCHIVE_ROOT = '/archive'
+# Prefixes of the data file names of the instruments whose files aren't named after the instrument,
+# e.g. MER00049009.nxs and MAR28041.raw, rather than e.g. SANS2D00012345.nxs
+FILE_PREFIXES = {'MERLIN': 'MER', 'MARI': 'MAR', 'MAPS': 'MAP'}
+# Changed when what is indexed changes, so that the indexes built before are rebuilt rather than reused
+INDEX_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    instrument TEXT,
+    run_number INTEGER,
+    ext TEXT,
+    path TEXT,
+    directory TEXT,
+    PRIMARY KEY (instrument, run_number, ext)
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    instrument TEXT,
+    mtime REAL
+);
+"""
+
+
+def run_file(instrument):
+    """
+    :param instrument: instrument name as in the archive, e.g. MERLIN
+    :return: regular expression matching the name of a run's data file, with the run number and the
+             extension as its groups
+    """
+    prefix = FILE_PREFIXES.get(instrument.upper(), instrument.upper())
+    return re.compile(r'^{}(\d+)(\.\w+)$'.format(re.escape(prefix)), re.IGNORECASE)
+
+
+class ArchiveIndex(object):
+    """
+    SQLite index of the run files of the archive
+    """
+
+    def __init__(self, archive_root=ARCHIVE_ROOT, db_path=None):
+        """
+        :param archive_root: directory containing the NDX<instrument> directories
+        :param db_path: database file, defaults to one per archive root in the autoreduction cache
+        """
+        self.archive_root = archive_root
+        db_name = '{}.sqlite'.format(cache_key(archive_root, INDEX_VERSION)[:16])
+        db_path = db_path or cache_path('archive_index', db_name)
+        # several reductions may update the index at the same time
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def cycle_dirs(self, instrument):
+        return sorted(glob.glob(os.path.join(self.archive_root, 'NDX' + instrument, 'Instrument', 'data', 'cycle_*')))
+
+    def update(self, instrument):
+        """
+        Rescan the cycle directories of an instrument that have changed since they were last scanned
+
+        :return: the number of directories scanned
+        """
+        scanned = dict(self.connection.execute(
+            "SELECT path, mtime FROM directories WHERE instrument = ?", (instrument,)).fetchall())
+        changed = 0
+        pattern = run_file(instrument)
+        for directory in self.cycle_dirs(instrument):
+            mtime = os.stat(directory).st_mtime
+            if scanned.get(directory) == mtime:
+                continue
+            rows = []
+            for entry in os.scandir(directory):
+                match = pattern.match(entry.name)
+                if match is not None:
+                    rows.append((instrument, int(match.group(1)), match.group(2).lower(), entry.path, directory))
+            with self.connection:
+                self.connection.execute("DELETE FROM files WHERE directory = ?", (directory,))
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO files (instrument, run_number, ext, path, directory) VALUES (?, ?, ?, ?, ?)",
+                    rows)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO directories (path, instrument, mtime) VALUES (?, ?, ?)",
+                    (directory, instrument, mtime))
+            changed += 1
+        return changed
+
+    def find(self, instrument, run_number, ext='.nxs'):
+        """
+        :return: the path of the run's file as currently indexed or None
+        """
+        row = self.connection.execute(
+            "SELECT path FROM files WHERE instrument = ? AND run_number = ? AND ext = ?",
+            (instrument, int(run_number), ext.lower())).fetchone()
+        return row[0] if row else None
+
+
+def find_run(instrument, run, ext='.nxs', archive_root=ARCHIVE_ROOT):
+    """
+    Find the data file of a run in the archive, updating the index if it isn't known yet
+
+    :param instrument: instrument name as in the archive, e.g. MERLIN
+    :param run: run number as an int or a string, optionally with an extension such as '49009.nxs'
+    :param ext: extension to use if run doesn't have one
+    :param archive_root: directory containing the NDX<instrument> directories
+    :return: full path to the file or None if it isn't in the archive
+    """
+    run, run_ext = os.path.splitext(str(run))
+    if not run.isdigit():
+        return None
+    index = ArchiveIndex(archive_root)
+    try:
+        path = index.find(instrument, run, run_ext or ext)
+        if path is None and index.update(instrument):
+            path = index.find(instrument, run, run_ext or ext)
+    finally:
+        index.close()
+    return path
+
+
+def add_search_dirs(instrument, runs, ext='.nxs'):
+    """
+    Put the directories of runs found in the archive at the front of Mantid's data search
+
+    For reductions that are given run numbers, so that Mantid finds them in the first directory it looks in.
+
+    :param runs: run numbers, None entries are ignored
+    :return: the paths of the runs that were found
+    """
+    from mantid import config
+
+    paths = [find_run(instrument, run, ext) for run in runs if run is not None]
+    paths = [path for path in paths if path is not None]
+    directories = [directory for directory in config['datasearch.directories'].split(';') if directory]
+    for directory in reversed(sorted(set(os.path.dirname(path) + '/' for path in paths))):
+        if directory in directories:
+            directories.remove(directory)
+        directories.insert(0, directory)
+    config['datasearch.directories'] = ';'.join(directories)
+    return paths
@@ -0,0 +1,156 @@
+"""
+Benchmark of the SANS journal matching on a synthetic journal
+-------------------------------------------------------------
+
+Generates a changer-style journal with the requested number of runs, checks
+that sans_journal.parse_measurements gives the same matches as the original
+nested-loop parseMeasurements from the SANS reduce.py scripts and reports the
+time taken by each, along with the time for a full and an incremental update
+of the journal index.
+
+Usage: python benchmark_sans_journal.py [--runs 10000]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import sans_journal
+
+
+def _legacy_parse_measurements(rblist):
+    # The original O(n^2) matching from the SANS reduce.py scripts, kept here as a reference
+    def find_all(a_str, sub):
+        start = 0
+        while True:
+            start = a_str.find(sub, start)
+            if start == -1:
+                return
+            yield start
+            start += len(sub)
+
+    def parseSANSTRANS(runtitle):
+        us = list(find_all(runtitle, '_'))
+        if len(us) == 0:
+            return 0
+        sanstrans = -1
+        if runtitle[us[-1] + 1:] == 'SANS':
+            sanstrans = 1
+            if len(us) > 1 and runtitle[us[-2] + 1:us[-1]] == 'TRANS':
+                sanstrans = 2
+        if runtitle[us[-1] + 1:] == 'TRANS':
+            sanstrans = 0
+        return sanstrans
+
+    def gettitles(runtitle):
+        lb = list(find_all(runtitle, '{'))
+        rb = list(find_all(runtitle, '}'))
+        if len(lb) == 1 and len(rb) == 1:
+            return [runtitle[lb[0] + 1:rb[0]], '']
+        if len(lb) == 2 and len(rb) == 2:
+            return [runtitle[lb[0] + 1:rb[0]], runtitle[lb[1] + 1:rb[1]]]
+        return [runtitle, '']
+
+    meas = []
+    trans = []
+    for i in range(len(rblist[0])):
+        st = parseSANSTRANS(rblist[2][i])
+        samp, can = gettitles(rblist[2][i])
+        if st == 1 or st == 2:
+            meas.append([rblist[0][i], samp, -1, can, -1, -1])
+        else:
+            trans.append([rblist[0][i], samp])
+    for i in range(len(meas)):
+        for j in range(len(trans)):
+            if meas[i][1] == trans[j][1]:
+                meas[i][4] = trans[j][0]
+    for i in range(len(meas)):
+        for j in range(len(meas)):
+            if meas[i][3] == meas[j][1] and len(meas[i][1]) > 0:
+                meas[i][2] = meas[j][0]
+    for i in range(len(meas)):
+        for j in range(len(trans)):
+            if meas[i][3] == trans[j][1] and len(meas[i][3]) > 0:
+                meas[i][5] = trans[j][0]
+    return [meas, trans]
+
+
+def synthetic_runs(n_runs, rb_number=2055010, seed=0):
+    """
+    Build [runs, rbs, titles] for a sample changer experiment with n_runs runs
+    """
+    rng = random.Random(seed)
+    n_samples = max(1, n_runs // 8)
+    runs, titles = [], []
+    run = 60000
+    while len(runs) < n_runs:
+        sample = rng.randrange(n_samples)
+        can = 'can{}'.format(sample % 10)
+        kind = rng.choice(['SANS', 'TRANS', 'SANS', 'TRANS_SANS'])
+        if rng.random() < 0.1:
+            title = '{{{}}}_{}'.format(can, kind)
+        else:
+            title = '{{sample{}}}{{{}}}_{}'.format(sample, can, kind)
+        runs.append(run)
+        titles.append(title)
+        run += 1
+    return [runs, [rb_number] * len(runs), titles]
+
+
+def _journal_entry(run, rb_number, title):
+    return ('  <NXentry name="SANS2D{:08d}">\n    <title>{}</title>\n    <start_time/>\n    <end_time/>\n'
+            '    <duration/>\n    <proton_charge/>\n    <experiment_identifier>{}</experiment_identifier>\n'
+            '  </NXentry>\n').format(run, title, rb_number)
+
+
+def _write_journal(path, rb_runs):
+    with open(path, 'w') as journal:
+        journal.write('<?xml version="1.0" encoding="UTF-8"?>\n<NXroot>\n')
+        for run, rb_number, title in zip(*rb_runs):
+            journal.write(_journal_entry(run, rb_number, title))
+        journal.write('</NXroot>\n')
+
+
+def run_benchmark(n_runs):
+    rb_runs = synthetic_runs(n_runs)
+
+    start = time.time()
+    new = sans_journal.parse_measurements(rb_runs)
+    new_time = time.time() - start
+    start = time.time()
+    legacy = _legacy_parse_measurements(rb_runs)
+    legacy_time = time.time() - start
+    if new != legacy:
+        raise RuntimeError("parse_measurements results differ from the original implementation")
+    print("parseMeasurements on {} runs: original {:.3f}s, single pass {:.4f}s ({:.0f}x faster)".format(
+        n_runs, legacy_time, new_time, legacy_time / max(new_time, 1e-9)))
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        journal_path = os.path.join(work_dir, 'journal_20_2.xml')
+        index = sans_journal.JournalIndex(os.path.join(work_dir, 'journal.sqlite'))
+        _write_journal(journal_path, rb_runs)
+        start = time.time()
+        index.update(journal_path)
+        print("Full journal index build: {:.3f}s".format(time.time() - start))
+
+        extra = [[run + n_runs for run in rb_runs[0][:10]], rb_runs[1][:10], rb_runs[2][:10]]
+        _write_journal(journal_path, [a + b for a, b in zip(rb_runs, extra)])
+        start = time.time()
+        added = index.update(journal_path)
+        print("Incremental update adding {} runs: {:.4f}s".format(added, time.time() - start))
+
+        start = time.time()
+        index.runs_for_rb(rb_runs[1][0])
+        print("Query of one RB: {:.4f}s".format(time.time() - start))
+        index.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=10000, help="Number of runs in the synthetic journal")
+    run_benchmark(parser.parse_args().runs)
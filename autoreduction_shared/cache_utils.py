@@ -0,0 +1,78 @@
+"""
+Helpers shared by the on-disk caches used by the autoreduction scripts
+"""
+import contextlib
+import fcntl
+import hashlib
+import os
+import time
+
+# Caches live on local disk of the reduction node, override with AUTOREDUCTION_CACHE_DIR
+CACHE_DIR = os.environ.get('AUTOREDUCTION_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'autoreduction'))
+
+
+def cache_path(*parts):
+    """
+    Return a path inside the cache directory, creating any parent directories
+
+    :param parts: path components relative to CACHE_DIR
+    """
+    path = os.path.join(CACHE_DIR, *parts)
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent, exist_ok=True)
+    return path
+
+
+def cache_key(*values):
+    """
+    Return a hex digest identifying a cache entry from the values it depends on
+
+    :param values: anything with a stable repr, e.g. run numbers, settings and file signatures
+    """
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def file_signature(file_path):
+    """
+    Return a (size, mtime) tuple used to detect that a file has changed
+    """
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on <path>.lock, for read-modify-write updates of a cache file shared by concurrent jobs
+    """
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def prune(directory, max_age_days):
+    """
+    Remove the files of a cache directory that haven't been modified for a number of days
+
+    Callers that reuse an entry touch it with os.utime so it is kept while it is in use.
+
+    :param directory: cache directory, as returned by cache_path
+    :param max_age_days: age of the oldest entry to keep
+    :return: the number of files removed
+    """
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            # removed by another job at the same time
+            pass
+    return removed
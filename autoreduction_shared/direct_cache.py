@@ -0,0 +1,548 @@
+"""
+Caches for the inputs of the direct geometry reductions
+-------------------------------------------------------
+
+The same white beam vanadium run is used for every sample run of a direct
+geometry experiment but used to be read from the archive and integrated again
+by each job. white_beam returns the run as a workspace, which the reduction
+wrappers accept in place of a run number for wb_run, from a local copy in the
+autoreduction cache directory or, when several runs are reduced by the same
+process, straight from memory. store_white_beam keeps the detector integrals a
+reduction calculates from it, keyed by the run, the normalisation, integration
+range and detector calibration, and seed_white_beam gives them to the next
+reduction in place of the run, which then isn't loaded at all. With
+use_hard_mask_only the diagnostics masks only depend on the white beam and the
+hard mask file, so they are kept and reused in the same way, with save_masks
+and load_masks. Each lookup reports whether it was a hit and the time saved.
+
+With a monovanadium run set, every sample run also used to recompute the
+absolute units factor for each incident energy. The factors a reduction
+calculates are now saved with store_monovan_factors, keyed by the monovanadium
+and white beam runs, the map file, the integration limits and the vanadium
+mass, and seed_monovan_factors hands all of them back to the next reduction
+with one read, before it starts, so it only calculates factors for new
+incident energies. A factor is only reused for the exact factor id it was
+calculated for, unless MONOVAN_EI_TOLERANCE is set, when energies within it of
+each other share a factor, as the energies refined from the monitors differ
+slightly between runs. The factors are held in DirectEnergyConversion's private
+state, so if a version of Mantid doesn't have it, seeding and storing them are
+skipped with a warning and the reduction calculates the factors itself.
+
+With sum_runs, every job used to load and add up all of the runs in the list
+again. summed_runs keeps the sum, with its monitors and proton charge, of the
+sorted run list on local disk, so when a run is added to the list only that run
+is loaded and added to the cached sum of the others. The sums are keyed by the
+files they contain, so a change to any of them invalidates every sum it is in,
+and the sum a new one was started from is deleted so only the longest is kept.
+"""
+import json
+import os
+import re
+import time
+
+import archive_index
+from cache_utils import cache_key, cache_path, file_signature, locked
+
+# Log DirectEnergyConversion adds to the white beam once it has been integrated
+WB_INTEGRALS_LOG = 'DET_WB_INTEGRALS'
+# Relative difference of incident energies, and integration ranges, that share an absolute units factor,
+# None to only reuse a factor for exactly the same factor id
+MONOVAN_EI_TOLERANCE = None
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def find_run_file(instrument, run, ext='.nxs'):
+    """
+    Find the data file of a run through the archive index or else Mantid's data search
+
+    :param instrument: instrument name, e.g. MERLIN
+    :param run: run number as an int or a string, optionally with an extension such as '49007.nxs'
+    :param ext: extension to use if run doesn't have one
+    :return: full path to the file
+    """
+    from mantid.api import FileFinder
+
+    path = archive_index.find_run(instrument, run, ext)
+    if path is not None:
+        return path
+    run, run_ext = os.path.splitext(str(run))
+    hint = '{}{}{}'.format(instrument, run, run_ext or ext)
+    found = FileFinder.findRuns(hint)
+    if not found:
+        raise RuntimeError("Unable to find the data file for {}".format(hint))
+    return found[0]
+
+
+class RunCache(object):
+    """
+    Loaded runs kept in memory and as processed NeXus files on local disk
+    """
+
+    def __init__(self, name, cache_dir=None):
+        """
+        :param name: name of the cache, used for the cache subdirectory and the log messages
+        :param cache_dir: directory of the cache files, defaults to <name> in the autoreduction cache
+        """
+        self.name = name
+        self.cache_dir = cache_dir or os.path.dirname(cache_path(name, 'index.json'))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _names(self, key):
+        # the hidden workspace, the processed NeXus file and the info file, written last, of an entry
+        digest = cache_key(*key)
+        return ('__{}_{}'.format(self.name, digest[:16]), os.path.join(self.cache_dir, digest + '.nxs'),
+                os.path.join(self.cache_dir, digest + '.json'))
+
+    def contains(self, key):
+        """
+        :return: whether there is a complete entry for key on disk
+        """
+        return os.path.exists(self._names(key)[2])
+
+    def peek(self, key, output):
+        """
+        Return a copy of the cached workspace for key, or None if it isn't cached
+
+        :param key: tuple of the values the workspace depends on
+        :param output: name of the copy returned to the caller, which may modify it
+        :return: the workspace or None
+        """
+        from mantid.simpleapi import mtd, CloneWorkspace, LoadNexusProcessed
+
+        cached, cache_file, info_file = self._names(key)
+        start = time.time()
+        if mtd.doesExist(cached):
+            source = 'memory'
+        elif os.path.exists(cache_file) and os.path.exists(info_file):
+            LoadNexusProcessed(Filename=cache_file, OutputWorkspace=cached)
+            source = 'disk'
+        else:
+            return None
+        CloneWorkspace(InputWorkspace=cached, OutputWorkspace=output)
+
+        with open(info_file) as info:
+            original = json.load(info)['seconds']
+        if original is None:
+            print("{} cache hit from {}".format(self.name, source))
+        else:
+            print("{} cache hit from {}, saved {:.1f}s".format(self.name, source, original - (time.time() - start)))
+        return mtd[output]
+
+    def store(self, key, workspace, seconds=None):
+        """
+        Keep a copy of a workspace as the entry for key
+
+        :param key: tuple of the values the workspace depends on
+        :param workspace: name of the workspace
+        :param seconds: the time it took to create the workspace, to report the time saved by a hit
+        """
+        from mantid.simpleapi import CloneWorkspace, SaveNexusProcessed
+
+        cached, cache_file, info_file = self._names(key)
+        if workspace != cached:
+            CloneWorkspace(InputWorkspace=workspace, OutputWorkspace=cached)
+        temp_file = '{}.tmp{}'.format(cache_file, os.getpid())
+        SaveNexusProcessed(InputWorkspace=cached, Filename=temp_file)
+        os.replace(temp_file, cache_file)
+        with open(info_file, 'w') as info:
+            json.dump({'key': repr(key), 'seconds': seconds}, info)
+
+    def get(self, key, load, output):
+        """
+        Return a copy of the cached workspace for key, creating it with load on a miss
+
+        :param key: tuple of the values the workspace depends on
+        :param load: function called with a workspace name to create the workspace
+        :param output: name of the copy returned to the caller, which may modify it
+        :return: the workspace
+        """
+        from mantid.simpleapi import mtd, CloneWorkspace
+
+        workspace = self.peek(key, output)
+        if workspace is not None:
+            return workspace
+        cached = self._names(key)[0]
+        start = time.time()
+        load(cached)
+        self.store(key, cached, time.time() - start)
+        CloneWorkspace(InputWorkspace=cached, OutputWorkspace=output)
+        print("{} cache miss, created in {:.1f}s".format(self.name, time.time() - start))
+        return mtd[output]
+
+
+def white_beam(instrument, wb_run, ext='.nxs'):
+    """
+    Return the white beam vanadium run as a workspace to pass as wb_run to a reduction
+
+    :param instrument: instrument name, e.g. MARI
+    :param wb_run: white beam run number, optionally with an extension
+    :param ext: data file extension if wb_run doesn't have one
+    :return: the white beam workspace, a copy which the reduction is free to modify
+    """
+    from mantid.simpleapi import Load
+
+    filename = find_run_file(instrument, wb_run, ext)
+    key = ('white_beam', instrument, os.path.basename(filename), file_signature(filename))
+    return RunCache('white_beam').get(key, lambda name: Load(Filename=filename, OutputWorkspace=name),
+                                      _white_beam_name(instrument, wb_run))
+
+
+def _white_beam_name(instrument, wb_run):
+    return 'wb_{}{}'.format(instrument, os.path.splitext(str(wb_run))[0])
+
+
+def _file_key(filename):
+    # A file given by path or by name on Mantid's data search, by its name and signature when found
+    if not isinstance(filename, str) or not filename or filename == 'None':
+        return str(filename)
+    from mantid.api import FileFinder
+
+    path = filename if os.path.isfile(filename) else FileFinder.getFullPath(filename)
+    return (os.path.basename(path), file_signature(path)) if path else filename
+
+
+def _run_descriptor(prop_man, name):
+    # The RunDescriptor of a run property, as used by DirectEnergyConversion itself
+    descriptor = getattr(type(prop_man), name, None)
+    if not hasattr(descriptor, 'get_workspace'):
+        raise RuntimeError("{} of {} is not a run descriptor, the reduction's property manager has changed".format(
+            name, type(prop_man).__name__))
+    return descriptor
+
+
+def _integrals_key(prop_man, filename):
+    # Everything the white beam integrals depend on besides the run
+    names = ('instr_name', 'normalise_method', 'wb_integr_range', 'mon1_norm_spec', 'norm_mon_integration_range')
+    return (('white_beam_integrals', os.path.basename(filename), file_signature(filename),
+             _file_key(getattr(prop_man, 'det_cal_file', None)))
+            + tuple(str(getattr(prop_man, name, None)) for name in names))
+
+
+def _masks_file(prop_man, filename):
+    # The cache file of the diagnostics masks, None unless they only depend on the white beam and hard mask
+    if not getattr(prop_man, 'use_hard_mask_only', False):
+        return None
+    key = ('diag_masks', str(prop_man.instr_name), os.path.basename(filename), file_signature(filename),
+           _file_key(getattr(prop_man, 'hard_mask_file', None)))
+    return cache_path('diag_masks', cache_key(*key) + '.xml')
+
+
+def save_masks(reducer, filename):
+    """
+    Save the diagnostics masks of a reduction to a Mantid XML mask file
+
+    :param reducer: the DirectEnergyConversion of a reduction wrapper, e.g. rd.reducer
+    :return: filename or None if the reduction has no masks
+    """
+    from mantid.simpleapi import SaveMask
+
+    if reducer.spectra_masks is None:
+        return None
+    temp_file = '{}.tmp{}.xml'.format(filename, os.getpid())
+    SaveMask(InputWorkspace=reducer.spectra_masks, OutputFile=temp_file)
+    os.replace(temp_file, filename)
+    return filename
+
+
+def load_masks(reducer, filename):
+    """
+    Give a reduction the diagnostics masks saved by save_masks, so that it doesn't run the diagnostics
+
+    Call after seed_white_beam, the white beam is used to map the masked detectors to spectra.
+    """
+    from mantid.simpleapi import LoadMask
+
+    prop_man = reducer.prop_man
+    workspace = _run_descriptor(prop_man, 'wb_run').get_workspace()
+    reducer.spectra_masks = LoadMask(Instrument=prop_man.instr_name, InputFile=filename,
+                                     RefWorkspace=workspace, OutputWorkspace=workspace.name() + '_masks')
+    print("Diagnostics masks loaded from {}".format(filename))
+
+
+def seed_white_beam(reducer, instrument, wb_run, ext='.nxs'):
+    """
+    Set the white beam vanadium of a reduction from the local caches
+
+    The detector integrals calculated by an earlier run with the same settings are used when they have
+    been cached, and otherwise the run itself from white_beam. The diagnostics masks are also given to
+    the reduction when they have been cached.
+
+    :param reducer: the DirectEnergyConversion of a reduction wrapper, e.g. rd.reducer
+    :param instrument: instrument name, e.g. MERLIN
+    :param wb_run: white beam run number, optionally with an extension
+    :param ext: data file extension if wb_run doesn't have one
+    :return: the workspace set as wb_run
+    """
+    prop_man = reducer.prop_man
+    filename = find_run_file(instrument, wb_run, ext)
+    output = _white_beam_name(instrument, wb_run)
+    workspace = RunCache('white_beam_integrals').peek(_integrals_key(prop_man, filename), output)
+    if workspace is None:
+        workspace = white_beam(instrument, wb_run, ext)
+    prop_man.wb_run = workspace
+    masks_file = _masks_file(prop_man, filename)
+    if masks_file is not None and os.path.exists(masks_file):
+        load_masks(reducer, masks_file)
+    return workspace
+
+
+def store_white_beam(reducer, instrument, wb_run, ext='.nxs'):
+    """
+    Save the white beam integrals and diagnostics masks calculated by a reduction for the following runs
+
+    :return: whether the integrals are cached
+    """
+    prop_man = reducer.prop_man
+    filename = find_run_file(instrument, wb_run, ext)
+    masks_file = _masks_file(prop_man, filename)
+    if masks_file is not None and not os.path.exists(masks_file):
+        save_masks(reducer, masks_file)
+
+    integrals = RunCache('white_beam_integrals')
+    key = _integrals_key(prop_man, filename)
+    if integrals.contains(key):
+        return True
+    workspace = _run_descriptor(prop_man, 'wb_run').get_workspace()
+    if workspace is None or not workspace.run().hasProperty(WB_INTEGRALS_LOG):
+        print("The reduction didn't keep the white beam integrals, they are not cached")
+        return False
+    integrals.store(key, workspace.name())
+    return True
+
+
+def run_number(filename, instrument):
+    """
+    :param instrument: instrument name, e.g. LET
+    :return: the run number in the name of a data file, e.g. 24374 for LET00024374.nxs
+    """
+    match = archive_index.run_file(instrument).match(os.path.basename(filename))
+    if match is None:
+        raise RuntimeError("No {} run number in the file name {}".format(instrument, filename))
+    return int(match.group(1))
+
+
+def summed_runs(instrument, runs, ext='.nxs'):
+    """
+    Return the sum of runs as a workspace to pass as sample_run to a reduction in place of sum_runs
+
+    The longest leading part of the sorted run list whose sum is cached is loaded from
+    the cache and only the runs after it are loaded from their files. The sum of the
+    whole list then replaces it in the cache.
+
+    :param instrument: instrument name, e.g. LET
+    :param runs: run numbers, optionally with an extension
+    :param ext: data file extension for runs without one
+    :return: the summed workspace, with the summed monitors in <name>_monitors
+    """
+    from mantid.simpleapi import mtd, DeleteWorkspace, Load, LoadNexusMonitors, LoadNexusProcessed, Plus, \
+        SaveNexusProcessed
+
+    runs = sorted(set(runs), key=lambda run: int(os.path.splitext(str(run))[0]))
+    files = [find_run_file(instrument, run, ext) for run in runs]
+    signatures = [(os.path.basename(filename), file_signature(filename)) for filename in files]
+    digests = [cache_key('run_sum', instrument, tuple(signatures[:count])) for count in range(1, len(files) + 1)]
+    cache_dir = os.path.dirname(cache_path('run_sum', 'index.json'))
+    output = 'sum_{}{}-{}'.format(instrument, run_number(files[0], instrument), run_number(files[-1], instrument))
+    start = time.time()
+
+    cached = 0
+    for count in range(len(files), 0, -1):
+        if os.path.exists(os.path.join(cache_dir, digests[count - 1] + '.json')):
+            cached = count
+            break
+    for suffix in ('', '_monitors'):
+        if cached:
+            LoadNexusProcessed(Filename=os.path.join(cache_dir, digests[cached - 1] + suffix + '.nxs'),
+                               OutputWorkspace=output + suffix)
+        elif mtd.doesExist(output + suffix):
+            # a sum left by an earlier call, the first run must not be added to it
+            DeleteWorkspace(output + suffix)
+    for filename in files[cached:]:
+        target = '__run_sum_next' if mtd.doesExist(output) else output
+        Load(Filename=filename, OutputWorkspace=target)
+        LoadNexusMonitors(Filename=filename, OutputWorkspace=target + '_monitors')
+        if target != output:
+            for suffix in ('', '_monitors'):
+                Plus(LHSWorkspace=output + suffix, RHSWorkspace=target + suffix, OutputWorkspace=output + suffix)
+                DeleteWorkspace(target + suffix)
+
+    charge = mtd[output].run().getProtonCharge()
+    if cached < len(files):
+        for suffix in ('', '_monitors'):
+            cache_file = os.path.join(cache_dir, digests[-1] + suffix + '.nxs')
+            temp_file = '{}.tmp{}'.format(cache_file, os.getpid())
+            SaveNexusProcessed(InputWorkspace=output + suffix, Filename=temp_file)
+            os.replace(temp_file, cache_file)
+        # written last as it marks the sum as complete
+        with open(os.path.join(cache_dir, digests[-1] + '.json'), 'w') as info:
+            json.dump({'runs': [name for name, _ in signatures], 'proton_charge': charge}, info)
+        # the sum of the shorter list is replaced by this one, the next job starts from the longest sum
+        if cached:
+            for suffix in ('.json', '.nxs', '_monitors.nxs'):
+                try:
+                    os.remove(os.path.join(cache_dir, digests[cached - 1] + suffix))
+                except OSError:
+                    pass
+    print("Sum of {} runs, {} from the cache and {} loaded, {:.2f} uAh in {:.1f}s".format(
+        len(files), cached, len(files) - cached, charge, time.time() - start))
+    return mtd[output]
+
+
+class MonovanFactorCache(object):
+    """
+    Absolute units correction factors for each incident energy, kept in a JSON file
+
+    The factors are grouped by a key made from everything the monovanadium integrals depend on,
+    so all of the incident energies of a run can be looked up with one read of the file. Within a
+    group they are kept under the ids the reduction gives them, which hold the incident energy and
+    the integration range.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or cache_path('monovan', 'factors.json')
+
+    def lookup(self, key, energies=None):
+        """
+        :param key: tuple of the values the factors depend on
+        :param energies: incident energies in meV, None for all of the cached ones
+        :return: dictionary of factor id to factor for the energies that have been cached, matching
+                 energies within MONOVAN_EI_TOLERANCE when it is set and exactly otherwise
+        """
+        cached = self._read().get(cache_key(*key), {})
+        if energies is None:
+            return cached
+        return {factor_id: factor for factor_id, factor in cached.items()
+                if any(_close([energy], _factor_values(factor_id)[:1]) for energy in energies)}
+
+    def store(self, key, factors):
+        """
+        :param key: tuple of the values the factors depend on
+        :param factors: dictionary of factor id to factor
+        """
+        if not factors:
+            return
+        # concurrent reductions, e.g. of each incident energy, all add their factors to the file
+        with locked(self.filename):
+            contents = self._read()
+            entry = contents.setdefault(cache_key(*key), {})
+            entry.update({str(factor_id): float(factor) for factor_id, factor in factors.items()})
+            temp_filename = '{}.tmp{}'.format(self.filename, os.getpid())
+            with open(temp_filename, 'w') as temp:
+                json.dump(contents, temp, indent=1)
+            os.replace(temp_filename, self.filename)
+
+    def _read(self):
+        try:
+            with open(self.filename) as factors:
+                return json.load(factors)
+        except (IOError, ValueError):
+            return {}
+
+
+def _factor_values(factor_id):
+    # The numbers in a factor id, e.g. Ei=2.5000e+01:Int(-1.0000e+01:1.00000e+01), incident energy first
+    return [float(value) for value in _NUMBER.findall(str(factor_id))]
+
+
+def _close(values, others):
+    tolerance = MONOVAN_EI_TOLERANCE or 0
+    return len(values) == len(others) and len(values) > 0 and all(
+        abs(value - other) <= tolerance * max(abs(value), abs(other)) for value, other in zip(values, others))
+
+
+class _NearbyFactors(dict):
+    """
+    Factors by id that also finds the factor of an id whose incident energy and integration range
+    are within MONOVAN_EI_TOLERANCE of the one asked for, as the energies refined from the monitors
+    differ slightly from run to run
+    """
+
+    def _match(self, factor_id):
+        if dict.__contains__(self, factor_id):
+            return factor_id
+        values = _factor_values(factor_id)
+        for other in self.keys():
+            if _close(values, _factor_values(other)):
+                return other
+        return None
+
+    def __contains__(self, factor_id):
+        return self._match(factor_id) is not None
+
+    def __getitem__(self, factor_id):
+        match = self._match(factor_id)
+        if match is None:
+            raise KeyError(factor_id)
+        return dict.__getitem__(self, match)
+
+    def get(self, factor_id, default=None):
+        return self[factor_id] if factor_id in self else default
+
+
+def _monovan_key(prop_man):
+    # Everything the absolute units integrals depend on besides the incident energy
+    names = ('instr_name', 'monovan_run', 'wb_for_monovan_run', 'wb_run',
+             'monovan_lo_frac', 'monovan_hi_frac', 'van_mass', 'van_rmm', 'norm_method')
+    # the map file by its signature, so that the factors are recalculated when it is edited
+    return (('monovan', _file_key(getattr(prop_man, 'monovan_mapfile', None)))
+            + tuple(str(getattr(prop_man, name, None)) for name in names))
+
+
+def _mono_factor_holder(reducer):
+    # The reduction keeps the factor for each incident energy in a dictionary on the mono_correction_factor
+    # descriptor, cashed_values in current versions of Mantid and _cor_factor_cash in older ones. These
+    # are private, so None, with a warning, when this version of Mantid has neither
+    holder = getattr(type(reducer.prop_man), 'mono_correction_factor', None)
+    for name in ('cashed_values', '_cor_factor_cash'):
+        if isinstance(getattr(holder, name, None), dict):
+            return holder, name
+    print("Warning: mono_correction_factor of {} has no dictionary of factors, absolute units factors "
+          "are not cached".format(type(reducer.prop_man).__name__))
+    return None, None
+
+
+def seed_monovan_factors(reducer, energies=None):
+    """
+    Give a reduction the absolute units factors cached by earlier runs so it doesn't recompute them
+
+    :param reducer: the DirectEnergyConversion of a reduction wrapper, e.g. rd.reducer
+    :param energies: the incident energies that will be reduced, all looked up at once, None when they
+                     aren't known in advance, e.g. with incident_energy AUTO, to use every cached energy
+    :return: the number of factors found
+    """
+    prop_man = reducer.prop_man
+    if not prop_man.monovan_run:
+        return 0
+    holder, name = _mono_factor_holder(reducer)
+    if holder is None:
+        return 0
+    # the reduction clears the factors when it starts with a different monovanadium run than the one
+    # they were set for, so set it first
+    if hasattr(holder, 'set_cash_mono_run_number'):
+        holder.set_cash_mono_run_number(_run_descriptor(prop_man, 'monovan_run').run_number())
+    elif hasattr(holder, '_mono_run_number'):
+        holder._mono_run_number = prop_man.monovan_run
+    else:
+        print("Warning: mono_correction_factor of {} has no monovanadium run to set, absolute units factors "
+              "are not cached".format(type(prop_man).__name__))
+        return 0
+    factors = MonovanFactorCache().lookup(_monovan_key(prop_man), energies)
+    if MONOVAN_EI_TOLERANCE:
+        setattr(holder, name, _NearbyFactors(getattr(holder, name)))
+    getattr(holder, name).update(factors)
+    if energies is None:
+        print("Absolute units factors cached for {} incident energies".format(len(factors)))
+    else:
+        print("Absolute units factors cached for {} of {} incident energies".format(len(factors), len(energies)))
+    return len(factors)
+
+
+def store_monovan_factors(reducer):
+    """
+    Save the absolute units factors calculated by a reduction for the following runs
+    """
+    prop_man = reducer.prop_man
+    if prop_man.monovan_run:
+        holder, name = _mono_factor_holder(reducer)
+        if holder is not None:
+            MonovanFactorCache().store(_monovan_key(prop_man), dict(getattr(holder, name)))
@@ -0,0 +1,166 @@
+"""
+File readiness gate
+-------------------
+
+Waits until a data file has finished being copied into place before it is
+reduced. A file is considered ready once its size and modification time have
+been stable for ``settle_time`` seconds and, for NeXus files, the HDF5
+superblock is present, is not flagged as open for writing and its recorded
+end-of-file address fits within the file on disk.
+
+inotify is used to wake up as soon as the file changes. As inotify does not see
+writes made by other hosts on network filesystems the file is also re-checked
+every ``poll_interval`` seconds.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+# The superblock may be found at byte 0 or at any power of two from 512 upwards
+HDF5_SUPERBLOCK_OFFSETS = [0, 512, 1024, 2048, 4096, 8192]
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+
+
+def _hdf5_complete(file_path):
+    """
+    Check the HDF5 superblock of a file to see whether it has been completely written
+
+    :return: True if the file looks complete, False if it is truncated, still open for writing
+             or can't be read, e.g. as it has just been replaced
+    """
+    try:
+        file_size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as data_file:
+            for offset in HDF5_SUPERBLOCK_OFFSETS:
+                if offset + 64 > file_size:
+                    return False
+                data_file.seek(offset)
+                header = data_file.read(64)
+                if header[:8] == HDF5_SIGNATURE:
+                    break
+            else:
+                return False
+    except OSError:
+        return False
+
+    version = header[8]
+    if version in (0, 1):
+        size_of_offsets = header[13]
+        flags = struct.unpack('<I', header[20:24])[0]
+        addresses_start = 24 if version == 0 else 28
+    elif version in (2, 3):
+        size_of_offsets = header[9]
+        flags = header[11]
+        addresses_start = 12
+    else:
+        # Unknown superblock version, fall back to relying on size/mtime stability alone
+        return True
+    if size_of_offsets not in (2, 4, 8):
+        return False
+    # Bit 0 of the consistency flags is set while a writer has the file open
+    if flags & 0x1:
+        return False
+
+    fmt = {2: '<H', 4: '<I', 8: '<Q'}[size_of_offsets]
+    # base address, then either free-space or superblock extension address, then end of file address
+    base_address = struct.unpack(fmt, header[addresses_start:addresses_start + size_of_offsets])[0]
+    eof_start = addresses_start + 2 * size_of_offsets
+    eof_address = struct.unpack(fmt, header[eof_start:eof_start + size_of_offsets])[0]
+    return base_address + eof_address <= file_size
+
+
+class _Inotify(object):
+    """
+    Minimal ctypes wrapper around the Linux inotify API
+    """
+
+    def __init__(self, directory):
+        self.fd = -1
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            return
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        """
+        Wait for up to timeout seconds for any event in the watched directory
+        """
+        if self.fd < 0:
+            time.sleep(timeout)
+            return
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            try:
+                # Drain the queued events, we only care that something happened
+                os.read(self.fd, 65536)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def wait_until_ready(file_path, timeout=300, settle_time=2.0, poll_interval=1.0, check_hdf5=None):
+    """
+    Block until a file has been completely written
+
+    The file must already exist, a missing file fails at once rather than after the timeout.
+
+    :param file_path: path to the file to wait for
+    :param timeout: maximum number of seconds to wait
+    :param settle_time: seconds for which the size and modification time must be unchanged
+    :param poll_interval: maximum seconds between checks of the file
+    :param check_hdf5: validate the HDF5 superblock, defaults to True for .nxs/.nx5/.h5 files
+    :return: the number of seconds spent waiting
+    """
+    if check_hdf5 is None:
+        check_hdf5 = os.path.splitext(file_path)[1].lower() in ('.nxs', '.nx5', '.h5', '.hdf5')
+    start = time.time()
+    directory = os.path.dirname(os.path.abspath(file_path))
+    watcher = _Inotify(directory)
+    last_seen = None
+    stable_since = None
+    try:
+        while True:
+            now = time.time()
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                raise RuntimeError("Unable to find file: {}".format(file_path))
+            seen = (stat.st_size, stat.st_mtime)
+            if seen != last_seen:
+                last_seen = seen
+                stable_since = now
+            settled = (now - stable_since >= settle_time) or (now - stat.st_mtime >= settle_time)
+            if settled and stat.st_size > 0 and (not check_hdf5 or _hdf5_complete(file_path)):
+                waited = time.time() - start
+                print("File {} ready after {:.2f}s".format(file_path, waited))
+                return waited
+            if now - start >= timeout:
+                raise RuntimeError("Timed out after {}s waiting for file to be ready: {}".format(timeout, file_path))
+            remaining = timeout - (now - start)
+            watcher.wait(min(poll_interval, remaining))
+    finally:
+        watcher.close()
@@ -0,0 +1,163 @@
+"""
+Reduction of repetition rate multiplication runs one incident energy per process
+--------------------------------------------------------------------------------
+
+Direct geometry runs with several incident energies, from incident_energy
+AUTO or a list of energies, used to be converted to energy transfer, rebinned
+and saved one energy after another by the reduction wrappers. For those
+settings the run is now loaded once with load_run and find_energies works out
+the energies, from its monitors with GetAllEi for AUTO. A run with a single
+energy, set or found, is reduced from its file exactly as before.
+
+reduce_energies reduces the first of several energies in the calling process,
+from the loaded run, while the others are reduced at the same time by a pool
+of worker processes, which all read a local copy of the run. Each worker
+integrates the white beam and runs the diagnostics itself, unless they are in
+the direct_cache caches from an earlier run of the experiment, which gives the
+same masks as the first energy as they only depend on the white beam and the
+run in time of flight. Each energy is saved into its own scratch directory and
+the files are moved into the output directory in order of incident energy when
+all of them have finished, with the wall time of each energy reported.
+"""
+import inspect
+import os
+import shutil
+import time
+
+import parallel_utils
+from cache_utils import cache_path
+
+# Expected peak memory of a worker reducing one incident energy
+EI_MEMORY_MB = 4000
+
+
+def is_auto(incident_energy):
+    return isinstance(incident_energy, str) and incident_energy.lower() == 'auto'
+
+
+def has_several(incident_energy):
+    """
+    :param incident_energy: the incident_energy setting, AUTO, a value or a list of values
+    :return: whether a run may be reduced at more than one energy, i.e. it is worth loading it for load_run
+    """
+    return is_auto(incident_energy) or (isinstance(incident_energy, (list, tuple)) and len(incident_energy) > 1)
+
+
+def load_run(input_file, output):
+    """
+    Load a run to reduce it from memory, with its monitors in <output>_monitors as the reductions expect
+
+    :return: the workspace, which can be passed as sample_run to a reduction
+    """
+    from mantid.simpleapi import Load, LoadNexusMonitors
+
+    LoadNexusMonitors(Filename=input_file, OutputWorkspace=output + '_monitors')
+    return Load(Filename=input_file, OutputWorkspace=output)
+
+
+def unload_run(output):
+    """
+    Delete a run loaded by load_run, with its monitors, when it isn't reduced from memory after all
+    """
+    from mantid.simpleapi import mtd, DeleteWorkspace
+
+    for name in (output, output + '_monitors'):
+        if mtd.doesExist(name):
+            DeleteWorkspace(name)
+
+
+def find_energies(run, incident_energy):
+    """
+    Work out the incident energies a run will be reduced at
+
+    :param run: name of the run loaded by load_run, only used for AUTO
+    :param incident_energy: the incident_energy setting, AUTO, a value or a list of values
+    :return: sorted list of the energies in meV, empty if they couldn't be found from the monitors
+    """
+    if not is_auto(incident_energy):
+        if not isinstance(incident_energy, (list, tuple)):
+            incident_energy = [incident_energy]
+        return sorted(float(energy) for energy in incident_energy)
+
+    from mantid.simpleapi import mtd, DeleteWorkspace, GetAllEi
+
+    try:
+        monitors = mtd[run + '_monitors']
+        instrument = monitors.getInstrument()
+        found = GetAllEi(Workspace=monitors,
+                         Monitor1SpecID=instrument.getIntParameter('ei-mon1-spec')[0],
+                         Monitor2SpecID=instrument.getIntParameter('ei-mon2-spec')[0],
+                         OutputWorkspace='__multi_ei_found')
+        energies = sorted(float(energy) for energy in found.readX(0))
+    except Exception as error:
+        print("Unable to find the incident energies from the monitors: {}".format(error))
+        energies = []
+    if mtd.doesExist('__multi_ei_found'):
+        DeleteWorkspace('__multi_ei_found')
+    return energies
+
+
+def _reduce_energy(script, function, kwargs):
+    # Runs in a worker process, returns the wall time of the reduction
+    start = time.time()
+    parallel_utils.call_script_function(script, function, kwargs)
+    return time.time() - start
+
+
+def reduce_energies(reduce, input_file, output_dir, energies, workers=None, first=None, **kwargs):
+    """
+    Reduce the first incident energy of a run in this process while the others are reduced in a pool of worker
+    processes
+
+    :param reduce: module level function of a reduce.py reducing one energy, called as
+                   reduce(input_file=..., output_dir=..., ei=..., **kwargs)
+    :param input_file: the run's data file
+    :param output_dir: directory the reduced files are gathered in
+    :param energies: the incident energies from find_energies
+    :param workers: the most worker processes to use, defaults to one per energy after the first
+    :param first: further arguments of the first energy only, e.g. the run loaded by load_run
+    :param kwargs: other arguments for reduce
+    :return: list of (energy, wall time in seconds, output files) in order of energy
+    """
+    scratch_dirs = [os.path.join(output_dir, '.ei{}_{}'.format(os.getpid(), index)) for index in range(len(energies))]
+    for scratch_dir in scratch_dirs:
+        os.makedirs(scratch_dir, exist_ok=True)
+    # for the local copy of the run
+    local_dir = os.path.dirname(cache_path('multi_ei', str(os.getpid()), ''))
+    start = time.time()
+    try:
+        # the workers all read a local copy rather than each reading the run from the archive,
+        # under the original name as the reductions take the run number from it
+        local_file = os.path.join(local_dir, os.path.basename(input_file))
+        shutil.copyfile(input_file, local_file)
+        jobs = [dict(script=os.path.abspath(inspect.getfile(reduce)), function=reduce.__name__,
+                     kwargs=dict(kwargs, input_file=local_file, output_dir=scratch_dir, ei=energy))
+                for energy, scratch_dir in zip(energies[1:], scratch_dirs[1:])]
+        workers = parallel_utils.max_workers(workers or len(jobs), EI_MEMORY_MB)
+        print("Reducing {} more incident energies with {} workers".format(len(jobs), workers))
+        pool, futures = parallel_utils.start_pool(_reduce_energy, jobs, workers)
+        with pool:
+            # the first energy is reduced here while the workers reduce the others
+            reduce(input_file=input_file, output_dir=scratch_dirs[0], ei=energies[0], **dict(kwargs, **(first or {})))
+            timings = [time.time() - start]
+            timings.extend(future.result() for future in futures)
+    except Exception:
+        for scratch_dir in scratch_dirs:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    results = []
+    for energy, seconds, scratch_dir in zip(energies, timings, scratch_dirs):
+        outputs = []
+        for filename in sorted(os.listdir(scratch_dir)):
+            outputs.append(os.path.join(output_dir, filename))
+            os.replace(os.path.join(scratch_dir, filename), outputs[-1])
+        os.rmdir(scratch_dir)
+        results.append((energy, seconds, outputs))
+        print("Ei {:8.3f} meV reduced in {:7.1f}s: {}".format(
+            energy, seconds, ', '.join(os.path.basename(output) for output in outputs)))
+    print("Reduced {} incident energies in {:.1f}s (total reduction time {:.1f}s)".format(
+        len(energies), time.time() - start, sum(timings)))
+    return results
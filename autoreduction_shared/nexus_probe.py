@@ -0,0 +1,123 @@
+"""
+Header-only NeXus probe
+-----------------------
+
+Reads the run metadata that the reduce.py scripts need to make decisions
+(title, RB number, run number, event or histogram data and selected sample logs)
+straight from the HDF5 tree of an ISIS NeXus file. Nothing is loaded into a
+Mantid workspace so a probe takes milliseconds and almost no memory.
+"""
+import h5py
+
+# Groups of an ISIS NXentry in which sample/instrument logs are stored
+LOG_GROUPS = ['selog', 'runlog', 'framelog']
+
+
+class RunInfo(object):
+    """
+    Metadata of a single run read from a NeXus file
+    """
+
+    def __init__(self, filename, title='', rb_number=None, run_number=None, is_event=False, logs=None):
+        self.filename = filename
+        self.title = title
+        self.rb_number = rb_number
+        self.run_number = run_number
+        self.is_event = is_event
+        self.logs = logs or {}
+
+    def first_log_value(self, name):
+        """
+        Return the first value of the named log, as Mantid's ``getProperty(name).value[0]`` would
+        """
+        values = self.logs.get(name)
+        if values is None or len(values) == 0:
+            return None
+        return values[0]
+
+    def __repr__(self):
+        return "RunInfo(filename={!r}, title={!r}, rb_number={!r}, run_number={!r}, is_event={!r})".format(
+            self.filename, self.title, self.rb_number, self.run_number, self.is_event)
+
+
+def _read_string(dataset):
+    """
+    Read a NeXus string dataset which may be stored as a scalar or a length one array
+    """
+    if dataset is None:
+        return ''
+    value = dataset[()]
+    if hasattr(value, 'shape') and value.shape:
+        value = value[0]
+    if isinstance(value, bytes):
+        value = value.decode('UTF-8', errors='replace')
+    return str(value).strip()
+
+
+def _read_int(dataset):
+    if dataset is None:
+        return None
+    value = dataset[()]
+    if hasattr(value, 'shape') and value.shape:
+        value = value[0]
+    if isinstance(value, bytes):
+        value = value.decode('UTF-8')
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _nx_class(group):
+    nx_class = group.attrs.get('NX_class', b'')
+    if isinstance(nx_class, bytes):
+        nx_class = nx_class.decode('UTF-8')
+    return nx_class
+
+
+def _has_event_data(entry):
+    for name, item in entry.items():
+        if isinstance(item, h5py.Group) and (_nx_class(item) == 'NXevent_data' or name.endswith('_events')):
+            return True
+    return False
+
+
+def _read_log(entry, name):
+    for group_name in LOG_GROUPS:
+        group = entry.get(group_name)
+        if group is None or name not in group:
+            continue
+        log = group[name]
+        # selog entries nest the NXlog one level down in value_log
+        if 'value_log' in log:
+            log = log['value_log']
+        if 'value' in log:
+            return log['value'][()]
+    return None
+
+
+def is_nexus(filename):
+    """
+    True if the file is HDF5 based NeXus rather than e.g. an ISIS raw file
+    """
+    return h5py.is_hdf5(filename)
+
+
+def probe(filename, logs=()):
+    """
+    Read the metadata of a run without loading it into a workspace
+
+    :param filename: path to the NeXus file
+    :param logs: names of sample logs to read the values of
+    :return: RunInfo describing the run
+    """
+    with h5py.File(filename, 'r') as nexus:
+        entry = nexus[list(nexus.keys())[0]]
+        info = RunInfo(filename,
+                       title=_read_string(entry.get('title')),
+                       rb_number=_read_int(entry.get('experiment_identifier')),
+                       run_number=_read_int(entry.get('run_number')),
+                       is_event=_has_event_data(entry))
+        for name in logs:
+            info.logs[name] = _read_log(entry, name)
+    return info
@@ -0,0 +1,95 @@
+"""
+Concurrent writing of reduced output files
+------------------------------------------
+
+Reductions typically finish by saving the same few workspaces in several
+formats, one file after another, to network storage. OutputWriter runs the
+save algorithms on a small thread pool instead. Each file is written under a
+temporary name in its destination directory and renamed into place once it is
+complete, so anything watching the output directory never sees a partial file.
+The HDF5 library isn't thread safe, so NeXus and other HDF5 files are written
+one at a time while the text formats are written alongside them. The time
+taken is reported when the writer is closed.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Extensions of the files written through HDF5, held to one save at a time in the process
+HDF5_EXTENSIONS = ('.nxs', '.nx5', '.nxspe', '.h5', '.hdf5', '.hdf')
+_hdf5_lock = threading.Lock()
+
+
+class OutputWriter(object):
+    """
+    Thread pool for save algorithms with atomic rename of the output files
+
+    Use as a context manager, all of the files have been written when the block exits:
+
+        with OutputWriter() as writer:
+            writer.submit(SaveGSS, path, InputWorkspace=name, Append=False, Bank=1)
+    """
+
+    def __init__(self, threads=4):
+        """
+        :param threads: the number of files written at the same time
+        """
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._futures = []
+        self._start = None
+        self.timings = []
+
+    def submit(self, save, filename, **kwargs):
+        """
+        Queue a file to be written
+
+        :param save: the save algorithm or function, called as save(Filename=..., **kwargs)
+        :param filename: the final path of the file
+        :param kwargs: other arguments for save, e.g. InputWorkspace
+        """
+        if self._start is None:
+            self._start = time.time()
+        self._futures.append(self._pool.submit(self._write, save, filename, kwargs))
+
+    def _write(self, save, filename, kwargs):
+        directory, basename = os.path.split(filename)
+        # keep the extension as some save algorithms check it
+        temp_filename = os.path.join(directory, '.tmp{}_{}'.format(os.getpid(), basename))
+        start = time.time()
+        try:
+            if os.path.splitext(basename)[1].lower() in HDF5_EXTENSIONS:
+                with _hdf5_lock:
+                    save(Filename=temp_filename, **kwargs)
+            else:
+                save(Filename=temp_filename, **kwargs)
+            os.replace(temp_filename, filename)
+        except Exception:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+        self.timings.append((filename, time.time() - start))
+
+    def close(self):
+        """
+        Wait for all of the files to be written and report the time taken
+
+        :return: the elapsed time in seconds since the first file was queued
+        """
+        self._pool.shutdown(wait=True)
+        errors = [future.exception() for future in self._futures if future.exception() is not None]
+        elapsed = time.time() - self._start if self._start is not None else 0.0
+        print("Wrote {} files in {:.2f}s (total write time {:.2f}s)".format(
+            len(self.timings), elapsed, sum(seconds for _, seconds in self.timings)))
+        if errors:
+            raise RuntimeError("Failed to write {} output files, first error: {}".format(len(errors), errors[0]))
+        return elapsed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.shutdown(wait=True)
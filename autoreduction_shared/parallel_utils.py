@@ -0,0 +1,131 @@
+"""
+Helpers for running independent parts of a reduction in a pool of worker processes
+-----------------------------------------------------------------------------------
+
+Workers are started with the 'spawn' method so that each one gets its own,
+freshly initialised Mantid framework rather than a forked copy of the parent's.
+The number of workers is capped per node by the AUTOREDUCTION_MAX_WORKERS
+environment variable and never exceeds the number of cores.
+"""
+import importlib.util
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+_loaded_scripts = {}
+
+
+def max_workers(requested=None, memory_per_worker_mb=None):
+    """
+    Work out how many worker processes may be used on this node
+
+    :param requested: the number of workers asked for by the caller, None for no preference
+    :param memory_per_worker_mb: expected peak memory of one worker used to limit the count
+                                 to what fits in the currently available memory
+    :return: the number of workers to use, at least 1
+    """
+    cores = os.cpu_count() or 1
+    workers = int(os.environ.get('AUTOREDUCTION_MAX_WORKERS', cores))
+    if requested:
+        workers = min(workers, requested)
+    if memory_per_worker_mb:
+        available = available_memory_mb()
+        if available:
+            workers = min(workers, int(available // memory_per_worker_mb))
+    return max(1, min(workers, cores))
+
+
+def available_memory_mb():
+    """
+    Return the memory available on the node in MB or None if it cannot be determined
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+def load_script(script_path):
+    """
+    Import a reduce.py by path inside a worker process, only once per process
+
+    :param script_path: full path to the script
+    :return: the imported module
+    """
+    script_path = os.path.abspath(script_path)
+    if script_path not in _loaded_scripts:
+        script_dir = os.path.dirname(script_path)
+        if script_dir not in sys.path:
+            sys.path.insert(0, script_dir)
+        name = 'autoreduction_script_{}'.format(len(_loaded_scripts))
+        spec = importlib.util.spec_from_file_location(name, script_path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        _loaded_scripts[script_path] = module
+    return _loaded_scripts[script_path]
+
+
+def call_script_function(script, function, kwargs):
+    """
+    Call a function of a reduce.py inside a worker process
+
+    :param script: full path to the script
+    :param function: name of the module level function to call
+    :param kwargs: keyword arguments for the function
+    :return: whatever the function returns, which must be picklable
+    """
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    return getattr(load_script(script), function)(**kwargs)
+
+
+def run_script_pool(script, function, jobs, workers):
+    """
+    Run a function of a reduce.py once for each job in a pool of worker processes
+
+    Functions defined in a reduce.py can't be sent to a worker directly as the
+    script is not importable by name, so the worker loads it from its path.
+
+    :param script: full path to the script
+    :param function: name of the module level function to call
+    :param jobs: list of keyword argument dictionaries, one per call
+    :param workers: the number of worker processes to use
+    :return: list of the results in the same order as jobs
+    """
+    jobs = [dict(script=script, function=function, kwargs=job) for job in jobs]
+    return run_pool(call_script_function, jobs, workers)
+
+
+def run_pool(function, jobs, workers):
+    """
+    Run function once for each job in a pool of spawned worker processes
+
+    :param function: module level function to run, called as function(**job)
+    :param jobs: list of keyword argument dictionaries, one per call
+    :param workers: the number of worker processes to use
+    :return: list of the results in the same order as jobs
+    """
+    if not jobs:
+        return []
+    pool, futures = start_pool(function, jobs, workers)
+    with pool:
+        return [future.result() for future in futures]
+
+
+def start_pool(function, jobs, workers):
+    """
+    Start running function once for each job in a pool of spawned worker processes, without waiting
+
+    :param function: module level function to run, called as function(**job)
+    :param jobs: non-empty list of keyword argument dictionaries, one per call
+    :param workers: the number of worker processes to use
+    :return: the pool, to be shut down by the caller, and a future for each job in the same order as jobs
+    """
+    context = multiprocessing.get_context('spawn')
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context)
+    return pool, [pool.submit(function, **job) for job in jobs]
@@ -0,0 +1,97 @@
+"""
+|Q|-energy slices of reduced direct geometry data
+-------------------------------------------------
+
+The slice plots shown by the webapp used to be made by re-loading each saved
+nxspe file with mslice. workspace_slice takes the reduced workspace straight
+from memory instead and histograms every spectrum's energy transfer bins onto
+|Q| with numpy, in a single bincount, giving the mean intensity in each bin.
+render_slice draws the result with matplotlib alone.
+"""
+import numpy as np
+
+# hbar^2 / 2m of the neutron in meV A^2
+E_TO_K2 = 2.0721
+
+
+def powder_slice(signal, energy_edges, two_theta, ei, n_q=200):
+    """
+    Histogram energy transfer spectra onto |Q|
+
+    :param signal: 2D array of intensity, one row per spectrum, NaN where there is no data
+    :param energy_edges: energy transfer bin edges in meV, shared by all spectra
+    :param two_theta: scattering angle of each spectrum in radians, NaN to leave a spectrum out
+    :param ei: incident energy in meV
+    :param n_q: number of |Q| bins from 0 to the largest |Q| reached
+    :return: (q_edges, energy_edges, intensity) with intensity of shape (n_q, number of energy bins)
+             and NaN in empty bins
+    """
+    signal = np.asarray(signal, dtype=float)
+    energy_edges = np.asarray(energy_edges, dtype=float)
+    two_theta = np.asarray(two_theta, dtype=float)
+    energy = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    n_energy = len(energy)
+
+    ki = np.sqrt(ei / E_TO_K2)
+    kf = np.sqrt(np.clip(ei - energy, 0.0, None) / E_TO_K2)
+    q = np.sqrt(ki ** 2 + kf[np.newaxis, :] ** 2 - 2.0 * ki * kf[np.newaxis, :] * np.cos(two_theta)[:, np.newaxis])
+    valid = np.isfinite(signal) & np.isfinite(q) & (energy < ei)[np.newaxis, :]
+    if not valid.any():
+        raise RuntimeError("No data to slice")
+
+    q_edges = np.linspace(0.0, q[valid].max(), n_q + 1)
+    q_index = np.clip(np.searchsorted(q_edges, q[valid], side='right') - 1, 0, n_q - 1)
+    energy_index = np.broadcast_to(np.arange(n_energy), signal.shape)[valid]
+    flat = q_index * n_energy + energy_index
+    total = np.bincount(flat, weights=signal[valid], minlength=n_q * n_energy)
+    count = np.bincount(flat, minlength=n_q * n_energy)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        intensity = np.where(count > 0, total / count, np.nan)
+    return q_edges, energy_edges, intensity.reshape(n_q, n_energy)
+
+
+def workspace_slice(workspace, n_q=200):
+    """
+    Make the |Q|-energy slice of a reduced workspace in energy transfer
+
+    :param workspace: Mantid workspace with the incident energy in the Ei log
+    :param n_q: number of |Q| bins
+    :return: dictionary of the arguments for render_slice other than the title and filename
+    """
+    spectrum_info = workspace.spectrumInfo()
+    two_theta = np.full(workspace.getNumberHistograms(), np.nan)
+    for index in range(len(two_theta)):
+        if spectrum_info.hasDetectors(index) and not (spectrum_info.isMonitor(index) or spectrum_info.isMasked(index)):
+            two_theta[index] = spectrum_info.twoTheta(index)
+    ei = workspace.run().getProperty('Ei').value
+    q_edges, energy_edges, intensity = powder_slice(workspace.extractY(), workspace.readX(0), two_theta, ei, n_q)
+    return dict(q_edges=q_edges, energy_edges=energy_edges, intensity=intensity, ei=ei)
+
+
+def render_slice(q_edges, energy_edges, intensity, ei, title, filename):
+    """
+    Save a slice as an image
+
+    The colour scale goes up to a fifth of the largest intensity between 0.1 and 0.9 Ei.
+
+    :return: filename
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    mesh = ax.pcolormesh(q_edges, energy_edges, np.ma.masked_invalid(intensity.T), cmap='viridis')
+    energy = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    inelastic = intensity[:, (energy > ei / 10) & (energy < ei * 0.9)]
+    if np.isfinite(inelastic).any():
+        mesh.set_clim(0.0, np.nanmax(inelastic) / 5)
+    cb = fig.colorbar(mesh, ax=ax)
+    cb.set_label('Intensity (arb. units)', labelpad=20, rotation=270)
+    ax.set_xlabel('|Q| ($\\AA^{-1}$)')
+    ax.set_ylabel('Energy transfer (meV)')
+    ax.set_title(title)
+    fig.savefig(filename, dpi=None)
+    plt.close(fig)
+    return filename
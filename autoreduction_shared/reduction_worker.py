@@ -0,0 +1,238 @@
+"""
+Warm autoreduction worker
+-------------------------
+
+Long lived process that imports the parts of the reduction stack that are safe
+to fork (numpy, h5py and matplotlib) once and then forks a fresh child for every
+job. The child inherits the already imported modules copy-on-write, loads the
+instrument's reduce.py/reduce_vars.py and calls ``main(input_file, output_dir)``
+exactly as a cold interpreter would.
+
+Mantid and the instrument packages built on it are not pre-imported. Importing
+mantid.simpleapi starts the FrameworkManager, whose thread pools and locks don't
+survive a fork, so each child imports them itself.
+
+Jobs are read from stdin as one JSON object per line::
+
+    {"script": "/isis/NDXGEM/user/scripts/autoreduction/reduce.py",
+     "input_file": "/archive/NDXGEM/Instrument/data/cycle_20_2/GEM83890.nxs",
+     "output_dir": "/instrument/GEM/RBNumber/RB1234/autoreduced/83890"}
+
+and one JSON line describing the outcome is written per job to the results
+file, a path or pipe given to the worker, kept apart from the jobs' own output
+on stdout. The worker exits with
+RECYCLE_EXIT_CODE once it has run ``max_jobs`` jobs or its resident memory has
+grown above ``max_rss_mb`` so that the supervising service can start a new one.
+"""
+import importlib
+import importlib.util
+import json
+import os
+import resource
+import sys
+import time
+import traceback
+
+# Ensure that Mantid does not attempt to plot to display
+os.environ['MPLBACKEND'] = 'Agg'
+
+# Modules imported by one or more of the NDX*/user/scripts/autoreduction/reduce.py scripts
+# that are expensive to import in a fresh interpreter and start no threads that a fork would lose
+PRELOAD_MODULES = [
+    'numpy',
+    'h5py',
+    'matplotlib',
+    'matplotlib.pyplot',
+]
+# Modules that must not be imported before forking, mantid starts the FrameworkManager's threads
+FORK_UNSAFE_MODULES = ['mantid']
+EXTRA_PATHS = ["/opt/Mantid/scripts"]
+
+RECYCLE_EXIT_CODE = 75
+
+
+def preload(modules=None):
+    """
+    Import the heavy reduction stack in the worker process
+
+    :param modules: list of module names to import, defaults to PRELOAD_MODULES
+    :return: tuple of (seconds spent importing, list of modules that could not be imported)
+    """
+    for path in EXTRA_PATHS:
+        if path not in sys.path:
+            sys.path.append(path)
+    missing = []
+    start = time.time()
+    for name in modules or PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            missing.append(name)
+    unsafe = [name for name in FORK_UNSAFE_MODULES if name in sys.modules]
+    if unsafe:
+        raise RuntimeError("Pre-importing imported {}, which can't be used in a forked child".format(
+            ", ".join(unsafe)))
+    return time.time() - start, missing
+
+
+def current_rss_mb():
+    """
+    Return the resident set size of this process in MB
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    # ru_maxrss is in KB on Linux and is a high water mark rather than the current value
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _run_script(script, input_file, output_dir, started=None):
+    """
+    Load the reduce.py at the given path and run its main function.
+    Only ever called inside the forked child.
+
+    :param started: called with no arguments once the script is loaded, just before main
+    """
+    script_dir = os.path.dirname(os.path.abspath(script))
+    # The script directory must win over any other autoreduction directory so that
+    # the instrument's own reduce_vars module is the one that gets imported
+    sys.path.insert(0, script_dir)
+    for name in ('reduce', 'reduce_vars'):
+        sys.modules.pop(name, None)
+    spec = importlib.util.spec_from_file_location('reduce', script)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['reduce'] = module
+    spec.loader.exec_module(module)
+    if started is not None:
+        started()
+    module.main(input_file, output_dir)
+
+
+class ReductionWorker(object):
+    """
+    Runs reduction jobs in forked children of a pre-imported parent process
+    """
+
+    def __init__(self, max_jobs=50, max_rss_mb=4096, modules=None):
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.jobs_run = 0
+        self.import_time, self.missing_modules = preload(modules)
+        print("Worker {} pre-imported reduction stack in {:.2f}s".format(os.getpid(), self.import_time))
+        if self.missing_modules:
+            print("Modules not available to pre-import: {}".format(", ".join(self.missing_modules)))
+
+    def run_job(self, script, input_file, output_dir):
+        """
+        Fork a child to run a single reduction job and wait for it to finish
+
+        :param script: full path to the instrument's reduce.py
+        :param input_file: path to the file to reduce
+        :param output_dir: path to the folder to output to
+        :return: dictionary describing the outcome of the job
+        """
+        start = time.time()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # the child reports how long it took to load the script, with its imports, before calling main
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+
+            def started():
+                os.write(write_end, "{:.6f}".format(time.time() - start).encode())
+                os.close(write_end)
+
+            exit_code = 0
+            try:
+                _run_script(script, input_file, output_dir, started)
+            except SystemExit as exp:
+                exit_code = exp.code if isinstance(exp.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            os._exit(exit_code)
+
+        os.close(write_end)
+        with os.fdopen(read_end) as startup:
+            startup = startup.read()
+        _, status, usage = os.wait4(pid, 0)
+        self.jobs_run += 1
+        if os.WIFEXITED(status):
+            exit_code = os.WEXITSTATUS(status)
+        else:
+            exit_code = -os.WTERMSIG(status)
+        result = {
+            'script': script,
+            'input_file': input_file,
+            'output_dir': output_dir,
+            'exit_code': exit_code,
+            'success': exit_code == 0,
+            'wall_time': time.time() - start,
+            'child_max_rss_mb': usage.ru_maxrss / 1024.0,
+            # measured in the child, None if it failed before main was called
+            'child_startup': float(startup) if startup else None,
+            'worker_preload_time': self.import_time,
+        }
+        print("Job finished in {:.2f}s, startup {}".format(
+            result['wall_time'], "{:.2f}s".format(result['child_startup']) if startup else "not reached"))
+        return result
+
+    def should_recycle(self):
+        """
+        True once the worker has run its quota of jobs or grown beyond its memory limit
+        """
+        if self.max_jobs and self.jobs_run >= self.max_jobs:
+            return True
+        return bool(self.max_rss_mb) and current_rss_mb() > self.max_rss_mb
+
+    def serve(self, results, stream=sys.stdin):
+        """
+        Run jobs read as JSON lines from stream until it is exhausted or the worker needs recycling
+
+        :param results: file the outcome of each job is written to as a JSON line
+        :return: the exit code the worker process should finish with
+        """
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+                result = self.run_job(job['script'], job['input_file'], job['output_dir'])
+            except (ValueError, KeyError) as exp:
+                result = {'success': False, 'error': "Invalid job {}: {}".format(line, exp)}
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+            if self.should_recycle():
+                print("Recycling worker {} after {} jobs ({:.0f} MB RSS)".format(os.getpid(), self.jobs_run,
+                                                                                 current_rss_mb()))
+                return RECYCLE_EXIT_CODE
+        return 0
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Run autoreduction jobs from a warm, pre-imported process")
+    parser.add_argument('--max-jobs', type=int, default=50,
+                        help="Number of jobs to run before the worker exits to be recycled (0 for no limit)")
+    parser.add_argument('--max-rss-mb', type=float, default=4096,
+                        help="Worker resident memory in MB above which it exits to be recycled (0 for no limit)")
+    parser.add_argument('--results', required=True,
+                        help="File or pipe the outcome of each job is written to as a JSON line")
+    args = parser.parse_args(argv)
+    worker = ReductionWorker(max_jobs=args.max_jobs, max_rss_mb=args.max_rss_mb)
+    with open(args.results, 'a') as results:
+        return worker.serve(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""
+Indexed cache of the ISIS cycle journals used by the SANS scripts
+-----------------------------------------------------------------
+
+The journal_<cycle>.xml files list every run of a cycle and only ever grow as
+runs are appended. Rather than re-parsing the whole journal for every reduction
+the run number, RB number and title of each entry are stored in an SQLite
+database. On each update only the bytes appended since the last recorded
+size/mtime are parsed (with iterparse) and the runs of a single RB can then be
+queried directly.
+
+The runs of an RB are matched into sample/can/transmission measurements in a
+single pass using dictionaries keyed by title (see parse_measurements).
+"""
+import hashlib
+import io
+import sqlite3
+import xml.etree.ElementTree as ET
+
+from cache_utils import cache_path, file_signature
+
+ENTRY_START = b'<NXentry'
+ENTRY_END = b'</NXentry>'
+# Number of bytes before the parsed offset used to check the journal was appended to rather than rewritten
+CHECK_BYTES = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_number INTEGER PRIMARY KEY,
+    rb_number INTEGER,
+    title TEXT,
+    position INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_rb_number ON runs (rb_number, position);
+CREATE TABLE IF NOT EXISTS source (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    xml_path TEXT,
+    size INTEGER,
+    mtime REAL,
+    offset INTEGER,
+    checksum TEXT
+);
+"""
+
+
+def _checksum(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _parse_entries(xml_bytes):
+    """
+    Parse a block of complete <NXentry> elements
+
+    :return: list of (run_number, rb_number, title) tuples
+    """
+    fragment = io.BytesIO(b'<journal>' + xml_bytes + b'</journal>')
+    entries = []
+    depth = 0
+    for event, element in ET.iterparse(fragment, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        # Journal entries are <NXentry name="INST00012345"> with the title first
+        # and the experiment identifier (RB number) sixth
+        try:
+            run_number = int(element.attrib['name'][-8:])
+            rb_number = int(element[5].text)
+        except (KeyError, IndexError, TypeError, ValueError):
+            element.clear()
+            continue
+        entries.append((run_number, rb_number, element[0].text or ''))
+        element.clear()
+    return entries
+
+
+class JournalIndex(object):
+    """
+    SQLite index of a single instrument cycle journal
+    """
+
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _source(self):
+        return self.connection.execute(
+            "SELECT xml_path, size, mtime, offset, checksum FROM source WHERE id = 0").fetchone()
+
+    def _reset(self):
+        self.connection.execute("DELETE FROM runs")
+        self.connection.execute("DELETE FROM source")
+
+    def update(self, xml_path):
+        """
+        Bring the index up to date with the journal file, parsing only newly appended entries
+
+        :param xml_path: path to the journal_<cycle>.xml file
+        :return: the number of entries added to the index
+        """
+        size, mtime = file_signature(xml_path)
+        source = self._source()
+        if source and source[0] == xml_path and source[1] == size and source[2] == mtime:
+            return 0
+
+        offset = 0
+        with open(xml_path, 'rb') as journal:
+            if source and source[0] == xml_path and source[3] <= size:
+                # Only continue from the recorded offset if the bytes before it are unchanged
+                start = max(0, source[3] - CHECK_BYTES)
+                journal.seek(start)
+                if _checksum(journal.read(source[3] - start)) == source[4]:
+                    offset = source[3]
+            journal.seek(offset)
+            data = journal.read()
+
+        with self.connection:
+            if offset == 0:
+                self._reset()
+            first = data.find(ENTRY_START)
+            last = data.rfind(ENTRY_END)
+            entries = []
+            if first != -1 and last > first:
+                end = last + len(ENTRY_END)
+                entries = _parse_entries(data[first:end])
+                offset += end
+            position = self.connection.execute("SELECT COALESCE(MAX(position), -1) FROM runs").fetchone()[0]
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO runs (run_number, rb_number, title, position) VALUES (?, ?, ?, ?)",
+                [(run, rb, title, position + 1 + i) for i, (run, rb, title) in enumerate(entries)])
+            with open(xml_path, 'rb') as journal:
+                start = max(0, offset - CHECK_BYTES)
+                journal.seek(start)
+                checksum = _checksum(journal.read(offset - start))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO source (id, xml_path, size, mtime, offset, checksum) VALUES (0, ?, ?, ?, ?, ?)",
+                (xml_path, size, mtime, offset, checksum))
+        return len(entries)
+
+    def runs_for_rb(self, rb_number):
+        """
+        Return the runs of a single RB in the [runs, rbs, titles] form used by the SANS scripts
+        """
+        rows = self.connection.execute(
+            "SELECT run_number, rb_number, title FROM runs WHERE rb_number = ? ORDER BY position",
+            (int(rb_number),)).fetchall()
+        return [[row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]]
+
+    def all_runs(self):
+        """
+        Return every run of the cycle as [rnums, rbnums, titles] in journal order
+        """
+        rows = self.connection.execute("SELECT run_number, rb_number, title FROM runs ORDER BY position").fetchall()
+        return [[row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]]
+
+
+def run_type(title):
+    """
+    Classify a run from the suffix of its title
+
+    :return: 1 for a SANS run, 2 for a TRANS_SANS run, 0 for a TRANS run and -1 otherwise
+    """
+    parts = title.split('_')
+    if len(parts) < 2:
+        # No underscores, nothing can be done with the run so treat it as a TRANS
+        return 0
+    if parts[-1] == 'SANS':
+        return 2 if len(parts) > 2 and parts[-2] == 'TRANS' else 1
+    if parts[-1] == 'TRANS':
+        return 0
+    return -1
+
+
+def split_title(title):
+    """
+    Split a run title into its sample and can names, given as {sample} or {sample}{can}
+
+    :return: [sample, can] where can is '' if no can is named
+    """
+    left = title.count('{')
+    right = title.count('}')
+    if left == 1 and right == 1:
+        return [title[title.index('{') + 1:title.index('}')], '']
+    if left == 2 and right == 2:
+        first_end = title.index('}')
+        second_start = title.index('{', title.index('{') + 1)
+        return [title[title.index('{') + 1:first_end], title[second_start + 1:title.index('}', first_end + 1)]]
+    return [title, '']
+
+
+def parse_measurements(rb_runs):
+    """
+    Match the SANS runs of an RB with their transmission, can and can transmission runs
+
+    Where several runs share a title the latest one in the journal is used.
+
+    :param rb_runs: [runs, rbs, titles] for a single RB
+    :return: [meas, trans] where each measurement is
+             [run, sample title, can SANS run, can title, sample TRANS run, can TRANS run]
+             with -1 for runs that could not be found, and each transmission is [run, sample title]
+    """
+    meas = []
+    trans = []
+    latest_sans = {}
+    latest_trans = {}
+    for run, title in zip(rb_runs[0], rb_runs[2]):
+        samp, can = split_title(title)
+        if run_type(title) in (1, 2):
+            meas.append([run, samp, -1, can, -1, -1])
+            latest_sans[samp] = run
+        else:
+            trans.append([run, samp])
+            latest_trans[samp] = run
+
+    for measurement in meas:
+        samp, can = measurement[1], measurement[3]
+        measurement[4] = latest_trans.get(samp, -1)
+        if len(samp) > 0:
+            measurement[2] = latest_sans.get(can, -1)
+        if len(can) > 0:
+            measurement[5] = latest_trans.get(can, -1)
+    return [meas, trans]
+
+
+def journal_index(inst, cycle):
+    """
+    Open the cached index for an instrument cycle journal
+    """
+    return JournalIndex(cache_path('journals', '{}_{}.sqlite'.format(inst.lower(), cycle)))
+
+
+def get_rb_runs(xml_path, inst, cycle, rb_number):
+    """
+    Update the cached index from the journal and return the runs of a single RB
+
+    :param xml_path: path to the journal_<cycle>.xml file
+    :param inst: instrument name
+    :param cycle: cycle string e.g. 20_2
+    :param rb_number: the RB number to return the runs of
+    :return: [runs, rbs, titles] for the RB
+    """
+    index = journal_index(inst, cycle)
+    try:
+        index.update(xml_path)
+        return index.runs_for_rb(rb_number)
+    finally:
+        index.close()
@@ -0,0 +1,60 @@
+"""
+Parallel execution of independent SANS reduction passes
+-------------------------------------------------------
+
+The wavelength-overlap and phi-sector reductions in the SANS scripts' reduceSANS
+only differ in their wavelength range or phi limits. Each pass is run in its own
+worker process with its own Mantid instance and the resulting I(Q) arrays are
+sent back to the parent, where they are recreated as workspaces so that the
+existing plotting functions can be used unchanged.
+"""
+import os
+
+from parallel_utils import load_script, run_pool
+
+
+def _reduce_pass(script, setup_kwargs, wav_start=None, wav_end=None, full_trans_wav=None,
+                 phi_limits=None, suffix=''):
+    # Runs inside the worker process
+    os.environ['MPLBACKEND'] = 'Agg'
+    reduce_script = load_script(script)
+    import sans.command_interface.ISISCommandInterface as ici
+    from mantid.simpleapi import mtd
+
+    reduce_script.setupReduction(**setup_kwargs)
+    ici.Set1D()
+    if phi_limits is not None:
+        ici.SetPhiLimit(phi_limits[0], phi_limits[1], use_mirror=False)
+    name = ici.WavRangeReduction(wav_start, wav_end, full_trans_wav)
+    workspace = mtd[name]
+    return {
+        'name': name + suffix,
+        'x': workspace.readX(0).copy(),
+        'y': workspace.readY(0).copy(),
+        'e': workspace.readE(0).copy(),
+        'distribution': workspace.isDistribution(),
+        'y_label': workspace.YUnitLabel(),
+    }
+
+
+def reduce_passes(script, setup_kwargs, passes, workers):
+    """
+    Run SANS reduction passes in parallel and publish their I(Q) to the ADS
+
+    :param script: full path to the instrument's reduce.py providing setupReduction
+    :param setup_kwargs: keyword arguments for setupReduction
+    :param passes: list of dictionaries with any of wav_start, wav_end, full_trans_wav,
+                   phi_limits and suffix for each pass
+    :param workers: maximum number of worker processes
+    :return: list of the output workspace names, in the order of passes
+    """
+    from mantid.simpleapi import CreateWorkspace
+
+    jobs = [dict(script=script, setup_kwargs=setup_kwargs, **reduction_pass) for reduction_pass in passes]
+    names = []
+    for result in run_pool(_reduce_pass, jobs, workers):
+        CreateWorkspace(DataX=result['x'], DataY=result['y'], DataE=result['e'], NSpec=1,
+                        UnitX='MomentumTransfer', Distribution=result['distribution'],
+                        YUnitLabel=result['y_label'], OutputWorkspace=result['name'])
+        names.append(result['name'])
+    return names
@@ -0,0 +1,103 @@
+"""
+Azimuthal sector I(Q) from a 2D Qx-Qy map
+-----------------------------------------
+
+Rather than re-running a complete reduction for each SetPhiLimit range, the
+sector curves used to check for anisotropy are histogrammed from the 2D Q map
+that the SANS scripts already produce. The |Q| bin and azimuthal angle of every
+pixel of the map are computed once, after which any number of sectors are
+averaged in a single np.bincount call.
+
+Angles follow the SetPhiLimit convention: degrees anticlockwise from +Qx, so
+0-180 is the top half of the detector and -90-90 the right half.
+"""
+import numpy as np
+
+# The half-detector sectors checked by the SANS scripts, as (suffix, phi min, phi max)
+HALF_SECTORS = [('_top', 0.0, 180.0), ('_bottom', 180.0, 360.0), ('_left', 90.0, 270.0), ('_right', -90.0, 90.0)]
+
+
+def equal_sectors(n_sectors):
+    """
+    Split the detector into n_sectors sectors of equal width
+
+    :return: list of (suffix, phi min, phi max)
+    """
+    width = 360.0 / n_sectors
+    return [('_phi{:g}_{:g}'.format(i * width, (i + 1) * width), i * width, (i + 1) * width)
+            for i in range(n_sectors)]
+
+
+def _centres(edges):
+    edges = np.asarray(edges, dtype=float)
+    return 0.5 * (edges[:-1] + edges[1:])
+
+
+class SectorIntegrator(object):
+    """
+    Averages a Qx-Qy map into I(Q) curves for a fixed set of azimuthal sectors
+    """
+
+    def __init__(self, qx_edges, qy_edges, q_edges, sectors):
+        """
+        :param qx_edges: Qx bin edges of the map columns
+        :param qy_edges: Qy bin edges of the map rows
+        :param q_edges: |Q| bin edges of the output curves
+        :param sectors: list of (suffix, phi min, phi max) in degrees
+        """
+        self.q_edges = np.asarray(q_edges, dtype=float)
+        self.n_q = len(self.q_edges) - 1
+        self.sectors = list(sectors)
+        qx_centres = _centres(qx_edges)
+        qy_centres = _centres(qy_edges)
+        self._shape = (len(qy_centres), len(qx_centres))
+        qx_grid, qy_grid = np.meshgrid(qx_centres, qy_centres)
+        q_mod = np.hypot(qx_grid, qy_grid).ravel()
+        phi = np.degrees(np.arctan2(qy_grid, qx_grid)).ravel() % 360.0
+
+        q_index = np.digitize(q_mod, self.q_edges) - 1
+        in_range = (q_index >= 0) & (q_index < self.n_q)
+
+        # Pairs of (pixel, output bin) for every sector a pixel belongs to, sectors may overlap
+        pixels = []
+        bins = []
+        for number, (_, phi_min, phi_max) in enumerate(self.sectors):
+            low = phi_min % 360.0
+            high = low + (phi_max - phi_min)
+            member = ((phi >= low) & (phi < high)) | ((phi + 360.0 >= low) & (phi + 360.0 < high))
+            selected = np.nonzero(member & in_range)[0]
+            pixels.append(selected)
+            bins.append(number * self.n_q + q_index[selected])
+        self._pixels = np.concatenate(pixels) if pixels else np.zeros(0, dtype=int)
+        self._bins = np.concatenate(bins) if bins else np.zeros(0, dtype=int)
+
+    def integrate(self, intensity, errors, mask=None):
+        """
+        Average the map into the sectors
+
+        :param intensity: 2D array of the map values, rows are Qy
+        :param errors: 2D array of the errors on the map values
+        :param mask: optional 2D boolean array, True for pixels to exclude. Non-finite pixels and
+                     pixels with zero value and error are always excluded.
+        :return: (q centres, 2D array of I(Q) per sector, 2D array of errors per sector)
+        """
+        intensity = np.asarray(intensity, dtype=float).reshape(self._shape).ravel()
+        errors = np.asarray(errors, dtype=float).reshape(self._shape).ravel()
+        valid = np.isfinite(intensity) & np.isfinite(errors) & ~((intensity == 0) & (errors == 0))
+        if mask is not None:
+            valid &= ~np.asarray(mask, dtype=bool).reshape(self._shape).ravel()
+
+        weights = valid[self._pixels].astype(float)
+        values = np.where(valid, intensity, 0.0)[self._pixels]
+        variances = np.where(valid, errors ** 2, 0.0)[self._pixels]
+        size = len(self.sectors) * self.n_q
+        counts = np.bincount(self._bins, weights=weights, minlength=size)
+        sums = np.bincount(self._bins, weights=values, minlength=size)
+        variance_sums = np.bincount(self._bins, weights=variances, minlength=size)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(counts > 0, sums / counts, 0.0)
+            error = np.where(counts > 0, np.sqrt(variance_sums) / counts, 0.0)
+        shape = (len(self.sectors), self.n_q)
+        q_centres = 0.5 * (self.q_edges[:-1] + self.q_edges[1:])
+        return q_centres, mean.reshape(shape), error.reshape(shape)
@@ -0,0 +1,181 @@
+"""
+Local cache of reduction scripts from the Mantid script repository
+------------------------------------------------------------------
+
+Some instruments import their reduction from the Mantid script repository,
+which used to mean installing the repository, listing every file and
+downloading the script over the network at the start of each job. Scripts are
+now kept in a content addressed store on local disk, objects/<sha256>, with an
+index of the repository path, checksum and fetch time of each one.
+
+A cached script is served straight away. When it is older than max_age it is
+refreshed from the repository in a background thread for the next job. A
+script can be pinned to a checksum, in which case only that exact content is
+ever served and the repository is only contacted if it isn't cached yet.
+
+The repository is any object with a fetch(repo_path) method returning the file
+contents, so DirectoryRepository can stand in for the real one when testing.
+"""
+import hashlib
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+
+from cache_utils import cache_path
+
+# Refresh unpinned scripts in the background once they are older than a day
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+class MantidScriptRepository(object):
+    """
+    The Mantid script repository, installed on first use
+    """
+
+    def __init__(self, install_dir='/tmp/repo'):
+        self.install_dir = install_dir
+        self._repo = None
+        self._lock = threading.Lock()
+
+    def fetch(self, repo_path):
+        from mantid.api import ScriptRepositoryFactory
+
+        with self._lock:
+            if self._repo is None:
+                repo = ScriptRepositoryFactory.Instance().create("ScriptRepositoryImpl")
+                repo.install(self.install_dir)
+                # listFiles is required for any download call to be successful
+                repo.listFiles()
+                self._repo = repo
+            self._repo.download(repo_path)
+        with open(os.path.join(self.install_dir, repo_path), 'rb') as script:
+            return script.read()
+
+
+class DirectoryRepository(object):
+    """
+    A local directory laid out like the script repository
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def fetch(self, repo_path):
+        with open(os.path.join(self.root, repo_path), 'rb') as script:
+            return script.read()
+
+
+class ScriptCache(object):
+    """
+    Content addressed cache of script repository files
+    """
+
+    def __init__(self, repository, cache_dir=None, max_age=DEFAULT_MAX_AGE):
+        """
+        :param repository: object with a fetch(repo_path) method returning bytes
+        :param cache_dir: directory of the cache, defaults to script_repository in the autoreduction cache
+        :param max_age: age in seconds after which an unpinned script is refreshed in the background
+        """
+        self.repository = repository
+        self.cache_dir = cache_dir or os.path.dirname(cache_path('script_repository', 'index.json'))
+        self.max_age = max_age
+        self.refresh_thread = None
+        self._lock = threading.Lock()
+        for directory in ('objects', 'modules'):
+            os.makedirs(os.path.join(self.cache_dir, directory), exist_ok=True)
+
+    def path(self, repo_path, pin=None):
+        """
+        Return the local path of a script, fetching it only if it isn't cached
+
+        :param repo_path: path of the script in the repository
+        :param pin: optional sha256 the script's content must have
+        :return: path to a copy of the script named as in the repository
+        """
+        entry = self._index().get(repo_path)
+        if pin is not None:
+            if not self._has_object(pin):
+                self._fetch(repo_path, pin)
+            return self._module_file(repo_path, pin)
+        if entry is None or not self._has_object(entry['sha256']):
+            entry = self._fetch(repo_path)
+        elif time.time() - entry['fetched'] > self.max_age:
+            self.refresh_thread = threading.Thread(target=self._refresh, args=(repo_path,), daemon=True)
+            self.refresh_thread.start()
+        return self._module_file(repo_path, entry['sha256'])
+
+    def import_script(self, repo_path, pin=None):
+        """
+        Import a script from the repository as a module
+
+        :return: the imported module
+        """
+        script = self.path(repo_path, pin)
+        module_dir = os.path.dirname(script)
+        if module_dir not in sys.path:
+            sys.path.insert(0, module_dir)
+        return importlib.import_module(os.path.splitext(os.path.basename(script))[0])
+
+    def _refresh(self, repo_path):
+        try:
+            self._fetch(repo_path)
+        except Exception as error:
+            print("Background refresh of {} failed: {}".format(repo_path, error))
+
+    def _fetch(self, repo_path, pin=None):
+        content = self.repository.fetch(repo_path)
+        sha256 = hashlib.sha256(content).hexdigest()
+        if pin is not None and sha256 != pin:
+            raise RuntimeError("{} in the script repository has checksum {}, expected {}".format(
+                repo_path, sha256, pin))
+        self._write(os.path.join(self.cache_dir, 'objects', sha256), content)
+        entry = {'sha256': sha256, 'fetched': time.time()}
+        with self._lock:
+            index = self._index()
+            index[repo_path] = entry
+            self._write(self._index_file(), json.dumps(index, indent=1).encode('utf-8'))
+        return entry
+
+    def _module_file(self, repo_path, sha256):
+        # Imports need the script under its own name, so copy the object to a per checksum directory
+        module_file = os.path.join(self.cache_dir, 'modules', sha256[:16], os.path.basename(repo_path))
+        if not os.path.exists(module_file):
+            os.makedirs(os.path.dirname(module_file), exist_ok=True)
+            with open(os.path.join(self.cache_dir, 'objects', sha256), 'rb') as cached:
+                self._write(module_file, cached.read())
+        return module_file
+
+    def _has_object(self, sha256):
+        return os.path.exists(os.path.join(self.cache_dir, 'objects', sha256))
+
+    def _index_file(self):
+        return os.path.join(self.cache_dir, 'index.json')
+
+    def _index(self):
+        try:
+            with open(self._index_file()) as index:
+                return json.load(index)
+        except (IOError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write(path, content):
+        temp_path = '{}.tmp{}.{}'.format(path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as temp:
+            temp.write(content)
+        os.replace(temp_path, path)
+
+
+def import_script(repo_path, pin=None, repository=None):
+    """
+    Import a reduction script from the Mantid script repository through the local cache
+
+    :param repo_path: path of the script in the repository, e.g. direct_inelastic/MARI/MARIReduction_Sample.py
+    :param pin: optional sha256 of the content to use
+    :param repository: repository to fetch from, defaults to the Mantid script repository
+    :return: the imported module
+    """
+    return ScriptCache(repository or MantidScriptRepository()).import_script(repo_path, pin)